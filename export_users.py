@@ -0,0 +1,8 @@
+import sys
+from utils.utils import user_db, get_data_file_path
+
+# Путь можно передать аргументом: python export_users.py users.json
+export_path = sys.argv[1] if len(sys.argv) > 1 else get_data_file_path('user_database_export.json')
+
+count = user_db.export_json(export_path)
+print(f"Выгружено пользователей: {count} -> {export_path}")
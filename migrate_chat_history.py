@@ -0,0 +1,16 @@
+import glob
+import os
+from utils.utils import DATA_DIR
+from utils.chat_storage import migrate_tinydb_history
+
+legacy_files = sorted(glob.glob(os.path.join(DATA_DIR, 'chat_history_*.json')))
+
+for json_path in legacy_files:
+    jsonl_path = os.path.splitext(json_path)[0] + '.jsonl'
+    if os.path.exists(jsonl_path):
+        print(f"Пропущен {json_path}: лог уже существует")
+        continue
+    count = migrate_tinydb_history(json_path, jsonl_path)
+    print(f"{json_path}: перенесено сообщений {count}")
+
+print("Миграция истории чатов завершена.")
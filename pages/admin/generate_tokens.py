@@ -1,8 +1,6 @@
 import streamlit as st
-from utils.utils import generate_and_save_token, get_data_file_path
+from utils.utils import generate_and_save_tokens
 from utils.page_config import setup_pages
-import os
-import json
 
 # Настраиваем страницы
 setup_pages()
@@ -23,27 +21,21 @@ if "admin_verified" not in st.session_state:
     
     st.session_state.admin_verified = True
 
-# Проверяем и создаем папку chat если её нет
-chat_dir = os.path.join(os.path.dirname(__file__), '..', '..', 'chat')
-os.makedirs(chat_dir, exist_ok=True)
-
-# Проверяем существование файла
-keys_file = get_data_file_path('access_keys.json')
-if not os.path.exists(keys_file):
-    with open(keys_file, 'w') as f:
-        json.dump({"keys": [], "generations": {}}, f)
-
 st.title("Генерация токенов (Админ панель)")
 
 with st.form("token_generation"):
-    num_tokens = st.number_input("Количество токенов", min_value=1, max_value=10, value=1)
+    num_tokens = st.number_input("Количество токенов", min_value=1, max_value=10000, value=1)
     generations = st.number_input("Количество генераций на токен", 
                                 min_value=10, max_value=1000, value=500)
     submit = st.form_submit_button("Сгенерировать")
 
 if submit:
-    for _ in range(num_tokens):
-        new_token = generate_and_save_token(generations)
-        st.code(new_token)
-        st.write(f"Токен успешно создан с {generations} генерациями")
+    # Все ключи сохраняются одной транзакцией
+    new_tokens = generate_and_save_tokens(num_tokens, generations)
+    if new_tokens:
+        st.code("\n".join(new_tokens))
+        st.write(f"Создано токенов: {len(new_tokens)}, по {generations} генераций")
+        st.download_button("Скачать список токенов", "\n".join(new_tokens), file_name="tokens.txt")
+    else:
+        st.error("Не удалось сохранить токены")
 
@@ -1,11 +1,9 @@
 import streamlit as st
 from utils.page_config import setup_pages
-import requests
-import json
 import os
-from tinydb import TinyDB, Query
 from utils.chat_database import ChatDatabase
-from utils.utils import get_data_file_path
+from utils.utils import user_db
+from utils.llm_client import chat_completion, LLMAPIError
 
 # Настраиваем страницы
 setup_pages()
@@ -102,26 +100,32 @@ with st.sidebar.expander("Настройки генерации", expanded=True)
 
 def get_chat_flows(username):
     """Получает список чат-потоков пользователя"""
-    user_db = TinyDB(get_data_file_path('user_database.json'))
-    User = Query()
-    user = user_db.get(User.username == username)
+    user = user_db.get(username)
     if user and 'chat_flows' in user:
         return user['chat_flows']
     return []
 
-def analyze_chat_history(username, chat_id=None, last_n_messages=10):
-    """Анализирует историю конкретного чата пользователя и возвращает релевантный контекст"""
+def analyze_chat_history(username, chat_id=None, last_n_messages=10, query=None):
+    """
+    Анализирует историю конкретного чата пользователя и возвращает релевантный контекст.
+    Если задан query, анализируются не последние сообщения, а наиболее близкие к нему.
+    """
     # Определяем ID чата
     chat_db_name = f"{username}_{chat_id}" if chat_id else f"{username}_main_chat"
     chat_db = ChatDatabase(chat_db_name)
-    history = chat_db.get_history()
+    if query:
+        history = chat_db.search(query, last_n_messages)
+        history_description = f"{len(history)} наиболее релевантных вопросу «{query}» сообщений"
+    else:
+        history = chat_db.tail(last_n_messages)
+        history_description = f"последние {last_n_messages} сообщений"
     
     if not history:
         return None
         
     # Форматируем историю в структурированный диалог
     formatted_history = []
-    for msg in history[-last_n_messages:]:
+    for msg in history:
         role = "Assistant" if msg['role'] == "assistant" else "User"
         formatted_history.append(f"{role}: {msg['content']}")
     
@@ -129,7 +133,7 @@ def analyze_chat_history(username, chat_id=None, last_n_messages=10):
     
     # Формируем промпт для анализа
     analysis_prompt = f"""[INST] Ты - ассистент с отличной памятью, анализирующий историю диалога. 
-    Проанализируй последние {last_n_messages} сообщений из истории чата и создай подробный отчет.
+    Проанализируй {history_description} из истории чата и создай подробный отчет.
     
     История диалога:
     {history_text}
@@ -166,34 +170,22 @@ def analyze_chat_history(username, chat_id=None, last_n_messages=10):
         settings = st.session_state.model_settings
         
         # Запрос к OpenRouter API для анализа
-        response = requests.post(
-            url="https://openrouter.ai/api/v1/chat/completions",
-            headers={
-                "Authorization": f"Bearer {st.secrets['openrouter']['api_key']}",
-                "HTTP-Referer": "https://github.com/cursor-ai",
-                "X-Title": "Cursor AI Assistant",
-                "Content-Type": "application/json"
-            },
-            data=json.dumps({
-                "model": settings["model"],
-                "messages": [
+        try:
+            analysis = chat_completion(
+                [
                     {
                         "role": "user",
                         "content": analysis_prompt
                     }
                 ],
-                "max_tokens": 2048,
-                "temperature": settings["temperature"],
-                "top_p": settings["top_p"],
-                "n": 1
-            })
-        )
-        
-        if response.status_code == 200:
-            response_data = response.json()
-            analysis = response_data['choices'][0]['message']['content'].strip()
-        else:
-            raise Exception(f"Ошибка при анализе контекста. Код ответа: {response.status_code}")
+                model=settings["model"],
+                max_tokens=2048,
+                temperature=settings["temperature"],
+                top_p=settings["top_p"],
+                n=1
+            ).strip()
+        except LLMAPIError as e:
+            raise Exception(f"Ошибка при анализе контекста. Код ответа: {e.status_code}")
         
         # Добавляем метаданные о чате
         chat_info = ""
@@ -230,7 +222,6 @@ def inject_context(original_message, context, chat_name=None):
 st.subheader("Тестирование анализа истории чата")
 
 # Выбор пользователя
-user_db = TinyDB(get_data_file_path('user_database.json'))
 users = [user['username'] for user in user_db.all()]
 selected_user = st.selectbox("Выберите пользователя:", users)
 
@@ -244,11 +235,19 @@ selected_chat = st.selectbox(
     key="selected_chat"
 )
 
+relevance_query = st.text_input(
+    "Вопрос для отбора сообщений (необязательно):",
+    key="relevance_query",
+    help="Если указан, анализируются сообщения чата, наиболее близкие к вопросу, а не последние"
+)
+
 if st.button("Проанализировать историю"):
     with st.spinner("Анализирую историю чата..."):
         context = analyze_chat_history(
             selected_user,
-            chat_id=selected_chat["id"] if selected_chat else None
+            chat_id=selected_chat["id"] if selected_chat else None,
+            last_n_messages=st.session_state.get("n_messages", 10),
+            query=relevance_query.strip() or None
         )
         if context:
             st.success("Анализ выполнен успешно")
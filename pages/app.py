@@ -1,24 +1,23 @@
 import streamlit as st
-import requests
-import hashlib
 from streamlit_extras.switch_page_button import switch_page
 from googletrans import Translator
-import os
-from PIL import Image
 import streamlit.components.v1 as components
-from tinydb import TinyDB, Query
-User = Query()  # Добавьте эту строку после импорта Query
-from utils.utils import update_remaining_generations, get_data_file_path
+from utils.utils import user_db, generation_quota
 from utils.chat_database import ChatDatabase
 from utils.page_config import PAGE_CONFIG, setup_pages
 from typing import List
-from utils.context_manager import ContextManager
-import json
-import time
-from utils.translation import translate_text, display_message_with_translation
+from utils.context_manager import ContextManager, RELEVANT_CONTEXT_K
+from utils.translation import translate_text, get_auto_translation, display_message_with_translation
+from utils.llm_jobs import llm_jobs
+from utils.job_view import show_pending_job
+from utils.avatars import get_user_avatar, get_assistant_avatar
+from utils.history_view import get_visible_history, reset_visible_history
+from utils.context_window import build_prompt, CONTEXT_TOKEN_BUDGET
 
 # Ключ для настроек основного чата
 MAIN_CHAT_SETTINGS_KEY = "main_chat_context_settings"
+# Ключ окна истории основного чата
+MAIN_CHAT_HISTORY_KEY = "main_chat_history_window"
 
 # Сначала конфигурация страницы
 st.set_page_config(
@@ -56,15 +55,12 @@ if 'username' not in st.session_state:
     st.stop()
 
 # Проверяем наличие активного токена и доступа
-user_db = TinyDB(get_data_file_path('user_database.json'))
-user_data = user_db.search(User.username == st.session_state.username)
+user_data = user_db.get(st.session_state.username)
 
 if user_data:
-    user_data = user_data[0]
-    
     # Синхронизируем session state с данными из базы
     st.session_state.active_token = user_data.get('active_token')
-    st.session_state.remaining_generations = user_data.get('remaining_generations', 0)
+    st.session_state.remaining_generations = generation_quota.remaining(st.session_state.username)
     st.session_state.access_granted = bool(user_data.get('active_token'))
     
     # Проверяем токен и статус доступа
@@ -80,71 +76,18 @@ else:
 # Инициализируем базы данных
 chat_db = ChatDatabase(f"{st.session_state.username}_main_chat")  # Добавляем суффикс для главной страницы
 
-# Папка с изображениями профиля (исправленный путь)
-PROFILE_IMAGES_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'profile_images'))
-ASSISTANT_ICON_PATH = os.path.join(PROFILE_IMAGES_DIR, 'assistant_icon.png')  # Путь к иконке ассистента
+# Аватар ассистента (миниатюра из общего кэша аватаров)
+assistant_avatar = get_assistant_avatar()
 
-# Проверем существование фал иконки ассстента
-if os.path.exists(ASSISTANT_ICON_PATH):
-    try:
-        assistant_avatar = Image.open(ASSISTANT_ICON_PATH)
-    except Exception as e:
-        st.error(f"Оибка при открытии изображения ассистента: {e}")
-        assistant_avatar = "🤖"  # Используем эмодзи по умолчанию
-else:
-    assistant_avatar = "🤖"  # Используем эмодзи по умолчанию
-
-# Функция для получения объекта изображения профиля пользователя
-def get_user_profile_image(username):
-    for ext in ['png', 'jpg', 'jpeg']:
-        image_path = os.path.join(PROFILE_IMAGES_DIR, f"{username}.{ext}")
-        if os.path.exists(image_path):
-            try:
-                return Image.open(image_path)
-            except Exception as e:
-                st.error(f"Ошибка при открытии изображения {image_path}: {e}")
-                return "👤"
-    return "👤"  # Возвращаем эмодзи, если изображение не найдено
-
-def get_message_hash(role, content):
-    """Создает уникальный хэш для сообщения"""
-    return hashlib.md5(f"{role}:{content}".encode()).hexdigest()
+
+def main_chat_job_key():
+    """Ключ фонового запроса к модели: пользователь и чат"""
+    return (st.session_state.username, chat_db.chat_id)
 
 def display_remaining_generations():
     if "remaining_generations" in st.session_state:
         st.sidebar.write(f"Осталось генераций: {st.session_state.remaining_generations}")
 
-def display_timer():
-    """Отображает анимированный секундомер"""
-    placeholder = st.empty()
-    for seconds in range(60):
-        time_str = f"⏱️ {seconds}с"
-        placeholder.markdown(f"""
-            <div style='
-                font-size: 1.2em;
-                font-weight: bold;
-                color: #1E88E5;
-                padding: 10px;
-                border-radius: 8px;
-                background-color: #E3F2FD;
-                text-align: center;
-                animation: pulse 1s infinite;
-            '>
-                {time_str}
-            </div>
-            <style>
-                @keyframes pulse {{
-                    0% {{ opacity: 1.0; }}
-                    50% {{ opacity: 0.6; }}
-                    100% {{ opacity: 1.0; }}
-                }}
-            </style>
-        """, unsafe_allow_html=True)
-        time.sleep(1)
-        if not st.session_state.get('waiting_response', True):
-            break
-    placeholder.empty()
-
 def submit_question():
     if not verify_user_access():
         return
@@ -154,144 +97,91 @@ def submit_question():
         st.warning("Пожалуйста, введите ваш вопрос.")
         return
 
+    job = llm_jobs.get(main_chat_job_key())
+    if job is not None and not job.finished:
+        st.warning("Предыдущий запрос еще выполняется. Дождитесь ответа.")
+        return
+
+    # Резервируем генерацию до запроса: параллельные вкладки не потратят больше, чем осталось
+    reservation = generation_quota.reserve(st.session_state.username)
+    if reservation is None:
+        st.error("У вас нет доступных генераций. Пожалуйста, активируйте новый токен.")
+        return
+
     try:
-        # Сначала сохраняем сообщение пользователя
-        user_hash = get_message_hash("user", user_input)
-        if user_hash not in st.session_state.message_hashes:
-            st.session_state.message_hashes.add(user_hash)
-            chat_db.add_message("user", user_input)
-            
-        # Отображаем сообщение пользователя
-        display_message({"role": "user", "content": user_input}, "user")
+        # Сначала сохраняем сообщение пользователя (повторная отправка того же вопроса его не дублирует)
+        user_message, _ = chat_db.add_message_once("user", user_input)
 
-        progress_container = st.empty()
-        start_time = time.time()
+        # Получаем настройки контекста
+        use_context = st.session_state[MAIN_CHAT_SETTINGS_KEY]["use_context"]
+        context_messages = st.session_state[MAIN_CHAT_SETTINGS_KEY]["context_messages"]
+        context_tokens = st.session_state[MAIN_CHAT_SETTINGS_KEY].get("context_tokens", CONTEXT_TOKEN_BUDGET)
         
-        with st.spinner('Обрабатываем ваш запрос...'):
-            api_url = "https://openrouter.ai/api/v1/chat/completions"
-            
-            # Получаем настройки контекста
-            use_context = st.session_state[MAIN_CHAT_SETTINGS_KEY]["use_context"]
-            context_messages = st.session_state[MAIN_CHAT_SETTINGS_KEY]["context_messages"]
-            
-            # Получаем историю с учетом настроек контекста
-            history = chat_db.get_history()
-            if use_context and history:
-                history = history[-context_messages:]
-            
-            # Формируем системное сообщение с учетом контекста
-            system_message = {
-                "role": "system",
-                "content": "Ты - профессиональный ассистент. Анализируй контекст диалога и давай релевантные ответы."
-            }
-            
-            # Формируем сообщения для API
-            messages = [system_message]
-            if use_context:
-                for msg in history:
-                    messages.append({
-                        "role": msg["role"],
-                        "content": msg["content"]
-                    })
-            
-            # Добавляем текущий вопрос
-            messages.append({
-                "role": "user",
-                "content": user_input
-            })
-            
-            payload = {
-                "model": st.session_state.get("selected_model", "google/gemini-flash-1.5"),
-                "messages": messages
-            }
-            
-            headers = {
-                "Authorization": f"Bearer {st.secrets['openrouter']['api_key']}",
-                "HTTP-Referer": "https://github.com/cursor-ai",
-                "X-Title": "Cursor AI Assistant",
-                "Content-Type": "application/json"
-            }
-            
-            response = requests.post(api_url, headers=headers, data=json.dumps(payload), timeout=100)
-            elapsed_time = int(time.time() - start_time)
-            
-            progress_container.info(f"⏱️ Время обработки: {elapsed_time} сек.")
-            
-            # Подробная обработка ошибок
-            if response.status_code == 500:
-                error_data = response.json()
-                error_message = error_data.get('message', 'Unknown error')
-                st.error(f"Ошибка сервера: {error_message}")
-                print(f"Server error details: {error_data}")
-                return
-                
-            if response.status_code != 200:
-                st.error(f"Ошибка API (код {response.status_code}): {response.text}")
-                return
-                
-            try:
-                output = response.json()
-                response_text = output['choices'][0]['message']['content']
-                
-                if not response_text:
-                    st.warning("Получен пустой ответ")
-                    return
-                
-                # Добавляем перевод ответа, если он на английском
-                try:
-                    # Проверяем, содержит ли текст английские символы
-                    if any(ord(char) < 128 for char in response_text):
-                        response_text = translate_text(response_text)
-                except Exception as e:
-                    st.error(f"Ошибка при переводе: {str(e)}")
-                
-                # Отображаем ответ ассистента
-                if response_text:
-                    assistant_message = {"role": "assistant", "content": response_text}
-                    display_message(assistant_message, "assistant")
-                    
-                    # Сохраняем сообщение в базу
-                    assistant_hash = get_message_hash("assistant", response_text)
-                    if assistant_hash not in st.session_state.message_hashes:
-                        st.session_state.message_hashes.add(assistant_hash)
-                        chat_db.add_message("assistant", response_text)
-                    
-                    # Обновляем количество генераций
-                    update_remaining_generations(st.session_state.username, -1)
-                    st.rerun()
-                    
-            except json.JSONDecodeError:
-                st.error("Ошибка при обработке ответа")
-                return
-                
-    except requests.exceptions.RequestException as e:
-        progress_container.empty()
-        st.error(f"Ошибка сети: {str(e)}")
-        print(f"Network error details: {str(e)}")
+        # Получаем только последние сообщения, нужные для контекста (без текущего вопроса)
+        history = []
+        relevant = []
+        if use_context:
+            history = [msg for msg in chat_db.tail(context_messages + 1) if msg["id"] != user_message["id"]]
+            history = history[-context_messages:]
+            # Более ранние сообщения чата, близкие к вопросу (локальный поиск по индексу чата)
+            relevant = chat_db.search(
+                user_input, RELEVANT_CONTEXT_K,
+                exclude_ids={msg["id"] for msg in history} | {user_message["id"]}
+            )
+        
+        # Системное сообщение, история в пределах бюджета токенов и текущий вопрос
+        messages = build_prompt(
+            "Ты - профессиональный ассистент. Анализируй контекст диалога и давай релевантные ответы.",
+            history,
+            user_input,
+            budget=context_tokens,
+            relevant=relevant
+        )
+        
+        model = st.session_state.get("selected_model", "google/gemini-flash-1.5")
+
+        def on_done(response_text):
+            # Ответ уже сохранен в истории: списываем генерацию и заранее запускаем перевод
+            generation_quota.commit(reservation)
+            get_auto_translation(response_text)
+
+        # Запрос выполняется в фоне и не прерывается перезапуском страницы
+        _, created = llm_jobs.submit(
+            main_chat_job_key(),
+            chat_db.chat_id,
+            messages,
+            model=model,
+            on_done=on_done,
+            on_error=lambda error: generation_quota.release(reservation)
+        )
+        if not created:
+            # Запрос этого чата уже выполняется (вторая вкладка): резерв не понадобился
+            generation_quota.release(reservation)
         
     except Exception as e:
+        generation_quota.release(reservation)
         st.error(f"Проиошла ошибка: {str(e)}")
         print(f"Unexpected error details: {str(e)}")
+        return
+
+    # Новый прогон покажет вопрос в истории и ответ по мере генерации
+    st.rerun()
 
 def clear_input():
     """Очистка поля ввода"""
     st.session_state.message_input = ""
 
-def display_message(message, role):
-    """Отображает сообщение с кнопками управления"""
-    message_hash = get_message_hash(role, message["content"])
-    avatar = assistant_avatar if role == "assistant" else get_user_profile_image(st.session_state.username)
-    
-    # Получаем номер сообщения
-    history = chat_db.get_history()
-    message_number = history.index(message) + 1
+def display_message(message, role, message_number=None):
+    """Отображает сообщение с кнопками управления; message_number - номер сообщения в истории"""
+    avatar = assistant_avatar if role == "assistant" else get_user_avatar(st.session_state.username)
+    message_key = chat_db.message_key(message)
     
     with st.chat_message(role, avatar=avatar):
         cols = st.columns([0.85, 0.1, 0.05])  # Изменили пропорции для кнопки удаления
         
         with cols[0]:
             message_placeholder = st.empty()
-            translation_key = f"translation_state_{message_hash}"
+            translation_key = f"translation_state_{message_key}"
             
             if translation_key not in st.session_state:
                 st.session_state[translation_key] = {
@@ -301,13 +191,20 @@ def display_message(message, role):
                 }
             
             current_state = st.session_state[translation_key]
+            # Ответы не на русском показываем в переводе, как только он готов (из кэша)
+            if role == "assistant" and not current_state["translated_text"]:
+                auto_translation = get_auto_translation(current_state["original_text"])
+                if auto_translation:
+                    current_state["translated_text"] = auto_translation
+                    current_state["is_translated"] = True
+            
             if current_state["is_translated"] and current_state["translated_text"]:
                 message_placeholder.markdown(current_state["translated_text"])
             else:
                 message_placeholder.markdown(current_state["original_text"])
         
         with cols[1]:
-            if st.button("🔄", key=f"translate_{message_hash}", help="Перевести сообщение"):
+            if st.button("🔄", key=f"translate_{message_key}", help="Перевести сообщение"):
                 current_state = st.session_state[translation_key]
                 if current_state["is_translated"]:
                     message_placeholder.markdown(current_state["original_text"])
@@ -321,18 +218,14 @@ def display_message(message, role):
                     
         # Добавляем кнопку удаления
         with cols[2]:
-            if st.button("🗑️", key=f"delete_{message_hash}", help="Удалить сообщение"):
-                chat_db.delete_message(message_hash)
-                if "message_hashes" in st.session_state:
-                    if message_hash in st.session_state.message_hashes:
-                        st.session_state.message_hashes.remove(message_hash)
-                    translation_key = f"translation_{message_hash}"
-                    if translation_key in st.session_state:
-                        del st.session_state[translation_key]
+            if st.button("🗑️", key=f"delete_{message_key}", help="Удалить сообщение"):
+                chat_db.delete_message(message["id"])
+                st.session_state.pop(translation_key, None)
                 st.rerun()
         
         # Добавляем номер сообщения
-        st.markdown(f"<div style='text-align: right; color: gray; font-size: 0.8em; margin-top: 5px;'>Сообщение #{message_number}</div>", unsafe_allow_html=True)
+        if message_number:
+            st.markdown(f"<div style='text-align: right; color: gray; font-size: 0.8em; margin-top: 5px;'>Сообщение #{message_number}</div>", unsafe_allow_html=True)
 
 def verify_user_access():
     """Проверка доступа пользователя"""
@@ -342,13 +235,13 @@ def verify_user_access():
         switch_page(PAGE_CONFIG["registr"]["name"])
         return False
         
-    user_data = user_db.search(User.username == st.session_state.username)
+    user_data = user_db.get(st.session_state.username)
     if not user_data:
         st.error("Пользователь не найден")
         switch_page(PAGE_CONFIG["registr"]["name"])
         return False
         
-    if not user_data[0].get('active_token'):
+    if not user_data.get('active_token'):
         st.warning("Пожалуйста, введите ключ доступа")
         switch_page(PAGE_CONFIG["key_input"]["name"])
         return False
@@ -358,27 +251,13 @@ def verify_user_access():
 def clear_chat_history():
     """Очистка истории чата"""
     chat_db.clear_history()  # Очистка базы данных истории чата
-    if "message_hashes" in st.session_state:
-        del st.session_state["message_hashes"]  # Сброс хэшей сообщений
+    reset_visible_history(MAIN_CHAT_HISTORY_KEY)
 
 def main():
-    # Инициализируем базу данных чата
-    chat_db = ChatDatabase(f"{st.session_state.username}_main_chat")
-    
-    # Получаем историю чата
-    chat_history = chat_db.get_history()
-    
-    # Инициализируем message_hashes, если его нет
-    if "message_hashes" not in st.session_state:
-        st.session_state.message_hashes = set()
-        # Добавляем все существующие хэши
-        for message in chat_history:
-            message_hash = get_message_hash(message["role"], message["content"])
-            st.session_state.message_hashes.add(message_hash)
-    
-    # Ображаем историю чата
-    for message in chat_history:
-        display_message(message, message["role"])
+    # Отображаем только последние сообщения чата; более ранние - по кнопке
+    visible_history, first_number = get_visible_history(chat_db, MAIN_CHAT_HISTORY_KEY)
+    for message_number, message in enumerate(visible_history, start=first_number):
+        display_message(message, message["role"], message_number)
     
     st.title("Бизнес-Идея")
 
@@ -398,6 +277,7 @@ def main():
         if st.session_state.main_clear_chat_confirm:
             # Выполняем очистку
             chat_db.clear_history()
+            reset_visible_history(MAIN_CHAT_HISTORY_KEY)
             st.session_state.main_clear_chat_confirm = False
             st.rerun()
         else:
@@ -421,7 +301,8 @@ def main():
     if MAIN_CHAT_SETTINGS_KEY not in st.session_state:
         st.session_state[MAIN_CHAT_SETTINGS_KEY] = {
             "use_context": True,
-            "context_messages": 10
+            "context_messages": 10,
+            "context_tokens": CONTEXT_TOKEN_BUDGET
         }
 
     # Нстройк котекста
@@ -440,11 +321,21 @@ def main():
             key=f"{MAIN_CHAT_SETTINGS_KEY}_slider",
             help="Количество последних сообщений, которые будут анализироваться для создания контекста."
         )
+        context_tokens = st.sidebar.slider(
+            "Лимит токенов запроса",
+            min_value=1000,
+            max_value=16000,
+            step=500,
+            value=st.session_state[MAIN_CHAT_SETTINGS_KEY].get("context_tokens", CONTEXT_TOKEN_BUDGET),
+            key=f"{MAIN_CHAT_SETTINGS_KEY}_tokens",
+            help="Самые новые сообщения берутся целиком, пока помещаются в лимит; более ранние обрезаются или отбрасываются."
+        )
 
     # Обновлем настройки в session_state
     st.session_state[MAIN_CHAT_SETTINGS_KEY].update({
         "use_context": use_context,
-        "context_messages": context_messages if use_context else 10
+        "context_messages": context_messages if use_context else 10,
+        "context_tokens": context_tokens if use_context else CONTEXT_TOKEN_BUDGET
     })
 
     # Поле ввода с возможностью растягивания
@@ -471,6 +362,10 @@ def main():
         with st.spinner('Отправляем ваш запрос...'):
             submit_question()
 
+    # Ответ, который генерируется в фоне (в том числе начатый до перезапуска страницы).
+    # Вызывается после всех виджетов: пока ответ не готов, прогон ждет его здесь
+    show_pending_job(main_chat_job_key(), assistant_avatar)
+
     # JavaScript для обработки Ctrl+Enter
     st.markdown("""
         <script>
@@ -1,18 +1,17 @@
 import streamlit as st
-import requests
 import json
-import os
-from PIL import Image
-import hashlib
-from utils.utils import verify_user_access, update_remaining_generations, get_data_file_path
+from utils.utils import verify_user_access, user_db, generation_quota
 from utils.chat_database import ChatDatabase
-from tinydb import TinyDB, Query
 from googletrans import Translator
-from utils.context_manager import ContextManager
+from utils.context_manager import ContextManager, RELEVANT_CONTEXT_K
 from datetime import datetime
 from utils.page_config import setup_pages
-import time
-from utils.translation import translate_text, display_message_with_translation
+from utils.translation import translate_text, get_auto_translation, display_message_with_translation
+from utils.llm_jobs import llm_jobs
+from utils.job_view import show_pending_job
+from utils.avatars import get_user_avatar, get_assistant_avatar
+from utils.history_view import get_visible_history, reset_visible_history
+from utils.context_window import build_prompt
 import unicodedata
 
 # Настройка страницы
@@ -38,49 +37,34 @@ if "openrouter" not in st.secrets or "api_key" not in st.secrets["openrouter"]:
     st.error("Ошибка: API ключ OpenRouter не настроен. Пожалуйста, обратитесь к администратору.")
     st.stop()
 
-# Инициализация путей для аватаров
-PROFILE_IMAGES_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'profile_images'))
-ASSISTANT_ICON_PATH = os.path.join(PROFILE_IMAGES_DIR, 'assistant_icon.png')
+# Аватар ассистента (миниатюра из общего кэша аватаров)
+assistant_avatar = get_assistant_avatar()
 
-# Загрузка аватара ассистента
-if os.path.exists(ASSISTANT_ICON_PATH):
-    try:
-        assistant_avatar = Image.open(ASSISTANT_ICON_PATH)
-    except Exception as e:
-        assistant_avatar = "🤖"
-else:
-    assistant_avatar = "🤖"
 
-def get_message_hash(role, content):
-    """Создает уникальный хэш для сообщения"""
-    return hashlib.md5(f"{role}:{content}".encode()).hexdigest()
+# Базы чатов текущего прогона скрипта: модуль выполняется заново при каждом rerun,
+# поэтому история каждого чата читается с диска не более одного раза за рендер
+_run_chat_dbs = {}
 
-def get_user_profile_image(username):
-    for ext in ['png', 'jpg', 'jpeg']:
-        image_path = os.path.join(PROFILE_IMAGES_DIR, f"{username}.{ext}")
-        if os.path.exists(image_path):
-            try:
-                return Image.open(image_path)
-            except Exception as e:
-                return "👤"
-    return "👤"
-
-def display_message(message, role):
-    """Отображает сообщение с кнопками управления"""
-    message_hash = get_message_hash(role, message["content"])
-    avatar = assistant_avatar if role == "assistant" else get_user_profile_image(st.session_state.username)
+def get_current_chat_db():
+    """Возвращает базу текущего чата, общую для всего прогона скрипта"""
+    chat_id = f"{st.session_state.username}_{st.session_state.current_chat_flow['id']}"
+    if chat_id not in _run_chat_dbs:
+        _run_chat_dbs[chat_id] = ChatDatabase(chat_id)
+    return _run_chat_dbs[chat_id]
+
+def display_message(message, role, message_number=None):
+    """Отображает сообщение с кнопками управления; message_number - номер сообщения в истории"""
+    avatar = assistant_avatar if role == "assistant" else get_user_avatar(st.session_state.username)
     
-    # Получаем номер сообщения
-    current_chat_db = ChatDatabase(f"{st.session_state.username}_{st.session_state.current_chat_flow['id']}")
-    history = current_chat_db.get_history()
-    message_number = history.index(message) + 1
+    current_chat_db = get_current_chat_db()
+    message_key = current_chat_db.message_key(message)
     
     with st.chat_message(role, avatar=avatar):
         cols = st.columns([0.85, 0.1, 0.05])  # Изменили пропорции для кнопки удаления
         
         with cols[0]:
             message_placeholder = st.empty()
-            translation_key = f"translation_state_{message_hash}"
+            translation_key = f"translation_state_{message_key}"
             
             if translation_key not in st.session_state:
                 st.session_state[translation_key] = {
@@ -90,13 +74,20 @@ def display_message(message, role):
                 }
             
             current_state = st.session_state[translation_key]
+            # Ответы не на русском показываем в переводе, как только он готов (из кэша)
+            if role == "assistant" and not current_state["translated_text"]:
+                auto_translation = get_auto_translation(current_state["original_text"])
+                if auto_translation:
+                    current_state["translated_text"] = auto_translation
+                    current_state["is_translated"] = True
+            
             if current_state["is_translated"] and current_state["translated_text"]:
                 message_placeholder.markdown(current_state["translated_text"])
             else:
                 message_placeholder.markdown(current_state["original_text"])
         
         with cols[1]:
-            if st.button("🔄", key=f"translate_{message_hash}", help="Перевести сообщение"):
+            if st.button("🔄", key=f"translate_{message_key}", help="Перевести сообщение"):
                 current_state = st.session_state[translation_key]
                 if current_state["is_translated"]:
                     message_placeholder.markdown(current_state["original_text"])
@@ -110,23 +101,19 @@ def display_message(message, role):
                     
         # Добавляем кнопку удаления
         with cols[2]:
-            if st.button("🗑️", key=f"delete_{message_hash}", help="Удалить сообщение"):
-                current_chat_db.delete_message(message_hash)
-                if "message_hashes" in st.session_state:
-                    if message_hash in st.session_state.message_hashes:
-                        st.session_state.message_hashes.remove(message_hash)
-                    translation_key = f"translation_{message_hash}"
-                    if translation_key in st.session_state:
-                        del st.session_state[translation_key]
+            if st.button("🗑️", key=f"delete_{message_key}", help="Удалить сообщение"):
+                current_chat_db.delete_message(message["id"])
+                st.session_state.pop(translation_key, None)
                 st.rerun()
         
         # Добавляем номер сообщения
-        st.markdown(f"<div style='text-align: right; color: gray; font-size: 0.8em; margin-top: 5px;'>Сообщение #{message_number}</div>", unsafe_allow_html=True)
+        if message_number:
+            st.markdown(f"<div style='text-align: right; color: gray; font-size: 0.8em; margin-top: 5px;'>Сообщение #{message_number}</div>", unsafe_allow_html=True)
 
 # Функция для сохранения нового чат-потока
 def save_chat_flow(username, flow_id, flow_name=None):
     """Сохраняет новый чат-поток"""
-    user = user_db.get(User.username == username)
+    user = user_db.get(username)
     if not user:
         return False
         
@@ -143,13 +130,13 @@ def save_chat_flow(username, flow_id, flow_name=None):
     }
     
     chat_flows.append(new_flow)
-    user_db.update({'chat_flows': chat_flows}, User.username == username)
+    user_db.update(username, {'chat_flows': chat_flows})
     return True
 
 # Функция для получения списка чат-потоков пользователя
 def get_user_chat_flows(username):
     """Получение списка чат-потоков пользователя"""
-    user = user_db.get(User.username == username)
+    user = user_db.get(username)
     if not user:
         return []
     
@@ -159,15 +146,14 @@ def get_user_chat_flows(username):
 def clear_chat_history(username, flow_id):
     chat_db = ChatDatabase(f"{username}_{flow_id}")
     chat_db.clear_history()
-    if "message_hashes" in st.session_state:
-        del st.session_state.message_hashes
+    reset_visible_history(f"history_window_{flow_id}")
     st.rerun()
 
 # Добавьте эту функцию после функции clear_chat_history
 
 def delete_chat_flow(username, flow_id):
     # Получаем текущего пользователя
-    user = user_db.get(User.username == username)
+    user = user_db.get(username)
     if not user:
         return False
     
@@ -178,7 +164,7 @@ def delete_chat_flow(username, flow_id):
     chat_flows = [flow for flow in chat_flows if flow['id'] != flow_id]
     
     # Обновляем список чатов в базе данных
-    user_db.update({'chat_flows': chat_flows}, User.username == username)
+    user_db.update(username, {'chat_flows': chat_flows})
     
     # Удаляем историю чата
     chat_db = ChatDatabase(f"{username}_{flow_id}")
@@ -186,16 +172,12 @@ def delete_chat_flow(username, flow_id):
     
     return True
 
-# Инициализация базы данных
-user_db = TinyDB(get_data_file_path('user_database.json'))
-User = Query()
-
 st.title("Личный помощник")
 
 # Отображение оставшихся генераций
-user = user_db.get(User.username == st.session_state.username)
+user = user_db.get(st.session_state.username)
 if user:
-    remaining_generations = user.get('remaining_generations', 0)
+    remaining_generations = generation_quota.remaining(st.session_state.username)
     st.sidebar.metric("Осталось генераций:", remaining_generations)
     
     if remaining_generations <= 0:
@@ -225,9 +207,7 @@ use_context = st.sidebar.checkbox(
 if use_context:
     # Получаем количество сообщений в текущем чате
     if 'current_chat_flow' in st.session_state:  # Проверяем наличие текущего чата
-        current_chat_db = ChatDatabase(f"{st.session_state.username}_{st.session_state.current_chat_flow['id']}")
-        history = current_chat_db.get_history()
-        max_messages = len(history) if history else 60
+        max_messages = get_current_chat_db().count() or 60
         
         # Получаем текущий диапазон из session_state или используем значение по умолчанию
         current_range = st.session_state[NEW_CHAT_SETTINGS_KEY].get("context_range", (1, 10))
@@ -286,8 +266,6 @@ if chat_flows:
     if ('current_chat_flow' not in st.session_state or 
         st.session_state.current_chat_flow['id'] != selected_flow['id']):
         st.session_state.current_chat_flow = selected_flow
-        if "message_hashes" in st.session_state:
-            del st.session_state.message_hashes
         st.rerun()
 
 # Создание нового чат-потока
@@ -343,8 +321,6 @@ if st.sidebar.button(
                 st.sidebar.success("Чат успешно удален!")
                 if 'current_chat_flow' in st.session_state:
                     del st.session_state.current_chat_flow
-                if 'message_hashes' in st.session_state:
-                    del st.session_state.message_hashes
                 st.session_state.new_chat_delete_confirm = False  # Изменили ключ
                 st.rerun()
     else:
@@ -381,144 +357,80 @@ if 'current_chat_flow' in st.session_state:
     st.markdown("---")
 
     # Инициализируем базу данных для текущего чата
-    current_chat_db = ChatDatabase(f"{st.session_state.username}_{st.session_state.current_chat_flow['id']}")
+    current_chat_db = get_current_chat_db()
     
-    # Отображение истории текущего чата
-    chat_history = current_chat_db.get_history()
-    for message in chat_history:
-        display_message(message, message["role"])
+    # Отображение последних сообщений текущего чата; более ранние - по кнопке
+    history_key = f"history_window_{st.session_state.current_chat_flow['id']}"
+    visible_history, first_number = get_visible_history(current_chat_db, history_key)
+    for message_number, message in enumerate(visible_history, start=first_number):
+        display_message(message, message["role"], message_number)
 
-# Функция отправки сообщения
-def display_timer():
-    """Отображает анимированный секундомер"""
-    placeholder = st.empty()
-    for seconds in range(60):
-        time_str = f"⏱️ {seconds}с"
-        placeholder.markdown(f"""
-            <div style='animation: blink 1s infinite'>
-                {time_str}
-            </div>
-            <style>
-                div {{
-                    font-size: 1.2em;
-                    font-weight: bold;
-                    color: #1E88E5;
-                    padding: 10px;
-                    border-radius: 8px;
-                    background-color: #E3F2FD;
-                    text-align: center;
-                }}
-                @keyframes blink {{
-                    0%, 100% {{ opacity: 1.0 }}
-                    50% {{ opacity: 0.5 }}
-                }}
-            </style>
-        """, unsafe_allow_html=True)
-        time.sleep(1)
-        if not st.session_state.get('waiting_response', True):
-            break
-    placeholder.empty()
+def current_chat_job_key():
+    """Ключ фонового запроса к модели: пользователь и чат"""
+    return (st.session_state.username, get_current_chat_db().chat_id)
 
+# Функция отправки сообщения
 def submit_message(user_input):
     if not user_input:
         st.warning("Пожалуйста, введите сообщение")
         return
+
+    current_chat_db = get_current_chat_db()
+    job = llm_jobs.get(current_chat_job_key())
+    if job is not None and not job.finished:
+        st.warning("Предыдущий запрос еще выполняется. Дождитесь ответа.")
+        return
         
-    if remaining_generations <= 0:
+    # Резервируем генерацию до запроса: параллельные вкладки не потратят больше, чем осталось
+    reservation = generation_quota.reserve(st.session_state.username)
+    if reservation is None:
         st.error("У вас нет активных генераций. Пожалуйста, активируйте новый токен.")
         return
         
     try:
-        progress_container = st.empty()
-        start_time = time.time()
+        # Получаем историю чата
+        history = current_chat_db.tail(10)
+        # Более ранние сообщения чата, близкие к вопросу (локальный поиск по индексу чата)
+        relevant = current_chat_db.search(
+            user_input, RELEVANT_CONTEXT_K, exclude_ids={msg["id"] for msg in history}
+        )
         
-        with st.spinner('Получаем ответ...'):
-            api_url = "https://openrouter.ai/api/v1/chat/completions"
-            
-            # Получаем историю чата
-            current_chat_id = st.session_state.current_chat_flow['id']
-            chat_db = ChatDatabase(f"{st.session_state.username}_{current_chat_id}")
-            history = chat_db.get_history()
-            
-            # Формируем сообщения для API с историей
-            messages = []
-            # Добавляем системное сообщение
-            messages.append({
-                "role": "system",
-                "content": "Ты - полезный ассистент. Используй контекст предыдущих сообщений для предоставления связных и контекстно-зависимых ответов."
-            })
-            
-            # Добавляем историю сообщений
-            for msg in history[-10:]:  # Берем последние 10 сообщений
-                messages.append({
-                    "role": msg["role"],
-                    "content": msg["content"]
-                })
-            
-            # Добавляем текущий вопрос пользователя
-            messages.append({
-                "role": "user",
-                "content": user_input
-            })
-            
-            payload = {
-                "model": "google/gemini-flash-1.5",
-                "messages": messages,
-                "max_tokens": 2048,
-                "temperature": 0.7,
-                "top_p": 0.9
-            }
-            
-            headers = {
-                "Authorization": f"Bearer {st.secrets['openrouter']['api_key']}",
-                "HTTP-Referer": "https://github.com/cursor-ai",
-                "X-Title": "Cursor AI Assistant",
-                "Content-Type": "application/json"
-            }
-
-            try:
-                # Сохраняем сообщение пользователя
-                user_hash = get_message_hash("user", user_input)
-                if "message_hashes" not in st.session_state:
-                    st.session_state.message_hashes = set()
-                
-                if user_hash not in st.session_state.message_hashes:
-                    st.session_state.message_hashes.add(user_hash)
-                    current_chat_db.add_message("user", user_input)
-
-                # Отправляем запрос
-                response = requests.post(api_url, headers=headers, json=payload)
-                elapsed_time = int(time.time() - start_time)
-                
-                if response.status_code == 200:
-                    progress_container.info(f"⏱️ Время обработки: {elapsed_time} сек.")
-                    
-                    try:
-                        response_data = response.json()
-                        assistant_response = response_data['choices'][0]['message']['content']
-                        
-                        if assistant_response:
-                            translated_response = translate_text(assistant_response)
-                            assistant_hash = get_message_hash("assistant", translated_response)
-                            
-                            if assistant_hash not in st.session_state.message_hashes:
-                                st.session_state.message_hashes.add(assistant_hash)
-                                current_chat_db.add_message("assistant", translated_response)
-                                update_remaining_generations(st.session_state.username, -1)
-                                st.rerun()
-                        else:
-                            st.error("Получен пустой ответ от API")
-                    except Exception as e:
-                        st.error(f"Ошибка при обработке ответа: {str(e)}")
-                else:
-                    st.error(f"Неожиданный ответ API (код {response.status_code})")
-                
-            except requests.exceptions.RequestException as e:
-                progress_container.empty()
-                st.error(f"Ошибка сети при отправке запроса: {str(e)}")
+        # Системное сообщение, последние сообщения в пределах бюджета токенов и текущий вопрос
+        messages = build_prompt(
+            "Ты - полезный ассистент. Используй контекст предыдущих сообщений для предоставления связных и контекстно-зависимых ответов.",
+            history,
+            user_input,
+            relevant=relevant
+        )
+        
+        # Сохраняем сообщение пользователя (повторная отправка того же вопроса его не дублирует)
+        current_chat_db.add_message_once("user", user_input)
+
+        def on_done(assistant_response):
+            # Ответ уже сохранен в истории: списываем генерацию и заранее запускаем перевод на русский
+            generation_quota.commit(reservation)
+            get_auto_translation(assistant_response)
+
+        # Запрос выполняется в фоне и не прерывается перезапуском страницы
+        _, created = llm_jobs.submit(
+            current_chat_job_key(),
+            current_chat_db.chat_id,
+            messages,
+            model="google/gemini-flash-1.5",
+            on_done=on_done,
+            on_error=lambda error: generation_quota.release(reservation)
+        )
+        if not created:
+            # Запрос этого чата уже выполняется (вторая вкладка): резерв не понадобился
+            generation_quota.release(reservation)
                 
     except Exception as e:
+        generation_quota.release(reservation)
         st.error(f"Общая ошибка: {str(e)}")
+        return
+
+    # Новый прогон покажет вопрос в истории и ответ по мере генерации
+    st.rerun()
 
 # Создаем контейнер для поля ввода
 input_container = st.container()
@@ -553,6 +465,10 @@ if send_button:  # Отправляем только при явном нажа
         st.session_state['_last_input'] = user_input
         submit_message(user_input)
 
+# Ответ, который генерируется в фоне (в том числе начатый до перезапуска страницы).
+# Вызывается после всех виджетов: пока ответ не готов, прогон ждет его здесь
+show_pending_job(current_chat_job_key(), assistant_avatar)
+
 def normalize_text(text):
     """Нормализует текст, исправляя проблемы с кодировкой"""
     if isinstance(text, bytes):
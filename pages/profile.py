@@ -1,9 +1,8 @@
 import streamlit as st
 from streamlit_extras.switch_page_button import switch_page
-from tinydb import TinyDB, Query
 import os
 from PIL import Image
-from utils.utils import check_token_status, format_database, update_remaining_generations, get_data_file_path
+from utils.utils import check_token_status, update_remaining_generations, user_db, generation_quota
 from utils.page_config import setup_pages, PAGE_CONFIG
 import hashlib
 import io
@@ -13,6 +12,7 @@ import requests
 from googletrans import Translator
 from utils.chat_database import ChatDatabase
 from utils.context_manager import ContextManager
+from utils.avatars import process_profile_image, invalidate_avatar
 import streamlit.components.v1 as components
 
 # После импортов
@@ -24,8 +24,6 @@ chat_db = ChatDatabase(f"{st.session_state.username}_profile_chat")
 
 def clear_chat_history():
     chat_db.clear_history()  # Очистка базы данных истории чата
-    if "message_hashes" in st.session_state:
-        del st.session_state["message_hashes"]  # Сброс хэшей сообщений
 
 # После импортов и перед st.set_page_config()
 def is_valid_image(file_content):
@@ -144,7 +142,7 @@ def main():
     # Отображение токена и количества генераций
     if user_data.get('active_token'):
         st.subheader("Доступные генерации")
-        remaining_generations = user_data.get('remaining_generations', 0)
+        remaining_generations = generation_quota.remaining(st.session_state.username)
         
         if remaining_generations > 0:
             st.success(f"Осталось генераций: {remaining_generations}")
@@ -168,7 +166,8 @@ def main():
                         st.success("Старое изображение успешно удалено.")
                     except Exception as e:
                         st.error(f"Ошибка при удалении файла: {e}")
-            user_db.update({'profile_image': None}, User.username == st.session_state.username)
+            user_db.update(st.session_state.username, {'profile_image': None})
+            invalidate_avatar(st.session_state.username)
             st.success("Фотография профиля удалена")
             st.rerun()
     else:
@@ -182,48 +181,40 @@ def main():
     confirm_password = st.text_input("Подтвердите новый пароль", type="password")
 
     # Загрузка новой фотографии профиля
-    new_profile_image = st.file_uploader("Загрузить новую фотографию профиля", type=["png", "jpg", "jpeg"])
+    new_profile_image = st.file_uploader("Загрузить новую фотографию профиля", type=["png", "jpg", "jpeg", "webp"])
     if new_profile_image is not None:
         st.image(new_profile_image, width=150)
-        updates = {}
-        needs_reload = False
+        upload_id = getattr(new_profile_image, "file_id", None) or f"{new_profile_image.name}:{new_profile_image.size}"
 
-        try:
+        # Файл остается в загрузчике между перезапусками скрипта, обрабатываем его один раз
+        if st.session_state.get("processed_profile_upload") != upload_id:
             # Проверяем размер файла
             MAX_FILE_SIZE = 2 * 1024 * 1024  # 2MB
             if new_profile_image.size > MAX_FILE_SIZE:
                 st.error("Размер файла превышает 2MB.")
                 st.stop()
 
-            # Генерируем имя файла
-            file_extension = os.path.splitext(new_profile_image.name)[1].lower()
-            image_filename = f"{user_data['username']}{file_extension}"
-            image_path = os.path.join(PROFILE_IMAGES_DIR, image_filename)
+            try:
+                # Декодер JPEG уменьшает изображение при чтении, поэтому обработка занимает доли секунды
+                with st.spinner("Обрабатываем изображение..."):
+                    image_path = process_profile_image(new_profile_image.getvalue(), user_data['username'])
+            except Exception as e:
+                st.error(f"Ошибка при обработке изображения: {e}")
+                st.stop()
 
             # Удаляем старое изображение
             old_image_path = user_data.get('profile_image')
-            if old_image_path and old_image_path != os.path.join(PROFILE_IMAGES_DIR, "default_user_icon.png"):
+            if old_image_path and os.path.abspath(old_image_path) != image_path \
+                    and os.path.basename(old_image_path) != "default_user_icon.png":
                 if os.path.exists(old_image_path):
                     try:
                         os.remove(old_image_path)
                     except Exception as e:
                         st.warning(f"Не удалось удалить старое изображение: {e}")
 
-            # Сохраняем новое изображение
-            with open(image_path, "wb") as f:
-                f.write(new_profile_image.getbuffer())
-
-            # Проверяем валидность изображения
-            img = Image.open(new_profile_image)
-            img.verify()
-            updates['profile_image'] = image_path
-            needs_reload = True
-
-        except Exception as e:
-            st.error(f"Ошибка при обработке изображения: {e}")
-            if 'image_path' in locals() and os.path.exists(image_path):
-                os.remove(image_path)
-            st.stop()
+            user_db.update(user_data['username'], {'profile_image': image_path})
+            st.session_state.processed_profile_upload = upload_id
+            st.success("Фотография профиля обновлена")
 
     if st.button("Обновить данные"):
         updates = {}
@@ -232,7 +223,7 @@ def main():
 
         # Обработка изменения имени пользователя и email
         if new_username and new_username != old_username:
-            existing_user = user_db.get(User.username == new_username)
+            existing_user = user_db.get(new_username)
             if existing_user:
                 st.error("Пользователь с таким именем уже существует")
             else:
@@ -258,10 +249,10 @@ def main():
         # Применяем все обновления
         if updates:
             try:
-                user_db.update(updates, User.username == old_username)
-                format_database()
+                user_db.update(old_username, updates)
                 
                 if 'username' in updates:
+                    invalidate_avatar(old_username)
                     st.session_state.username = updates['username']
                 
                 st.success("Данные успешно обновлены")
@@ -304,10 +295,7 @@ if __name__ == "__main__":
         switch_page(PAGE_CONFIG["registr"]["name"])
         st.stop()
 
-    # Инициализация базы данных пользователей
-    user_db = TinyDB(get_data_file_path('user_database.json'))
-    User = Query()
-    user_data = user_db.search(User.username == st.session_state.username)
+    user_data = user_db.get(st.session_state.username)
 
     if not user_data:
         st.error("Пользователь не найден.")
@@ -316,8 +304,6 @@ if __name__ == "__main__":
         st.session_state.is_admin = False
         st.rerun()
 
-    user_data = user_data[0]
-    
     # Запускаем основную функцию
     main()
 
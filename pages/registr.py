@@ -1,10 +1,9 @@
 import streamlit as st
 from streamlit_extras.switch_page_button import switch_page
-from tinydb import TinyDB, Query
 import os
 from PIL import Image
 from utils.page_config import setup_pages, PAGE_CONFIG
-from utils.utils import format_database, get_data_file_path
+from utils.utils import user_db
 from utils.security import hash_password, is_strong_password, verify_password, check_login_attempts, increment_login_attempts, reset_login_attempts
 from datetime import datetime
 
@@ -14,9 +13,6 @@ st.set_page_config(page_title="Вход/Регистрация", layout="wide",
 # Затем настройка страниц
 setup_pages()
 
-# Инициализация базы данных пользователей
-user_db = TinyDB(get_data_file_path('user_database.json'))
-
 # Убедимся, что папка для хранения изображений профиля существует
 PROFILE_IMAGES_DIR = 'profile_images'
 if not os.path.exists(PROFILE_IMAGES_DIR):
@@ -24,10 +20,9 @@ if not os.path.exists(PROFILE_IMAGES_DIR):
 
 # Функция для регистрации пользователя
 def register_user(username, email, password, profile_image_path=None):
-    User = Query()
-    if user_db.search(User.username == username):
+    if user_db.get(username):
         return False, "Пользователь с таким именем уже существует"
-    if user_db.search(User.email == email):
+    if user_db.get_by_email(email):
         return False, "Пользователь с таким email уже существует"
         
     # Проверка надежности пароля
@@ -47,21 +42,19 @@ def register_user(username, email, password, profile_image_path=None):
         'is_admin': False,
         'created_at': datetime.now().isoformat()
     }
-    user_db.insert(user_data)
-    format_database()
+    if not user_db.insert(user_data):
+        return False, "Пользователь с таким именем уже существует"
     return True, "Регистрация успешна"
 
 # Функция для входа в систему
 def login(username, password):
-    User = Query()
-    
     # Проверка попыток входа
     can_login, message = check_login_attempts(username)
     if not can_login:
         st.error(message)
         return False
     
-    user = user_db.get(User.username == username)
+    user = user_db.get(username)
     if user and verify_password(password, user['password']):
         st.session_state.authenticated = True
         st.session_state.username = username
@@ -97,8 +90,7 @@ if st.button("Войти"):
             setup_pages()
             switch_page(PAGE_CONFIG["key_input"]["name"])
         elif login(username, password):
-            User = Query()
-            user = user_db.get(User.username == username)
+            user = user_db.get(username)
             st.session_state.authenticated = True 
             st.session_state.username = username
             st.session_state.is_admin = user.get('is_admin', False)
@@ -1,10 +1,11 @@
 import streamlit as st
-import requests
 from time import sleep
 import hashlib
-import os
-from PIL import Image
-from googletrans import Translator
+import uuid
+from utils.llm_client import stream_chat_completion, LLMAPIError
+from utils.translation import translate_text
+from utils.avatars import get_user_avatar, get_assistant_avatar
+from utils.utils import response_cache
 
 # Настройка заголовка страницы
 st.set_page_config(
@@ -16,31 +17,13 @@ st.set_page_config(
 # Максимальное количество ответов от API
 MAX_API_RESPONSES = 5
 
-# Папка с изображениями профиля
-PROFILE_IMAGES_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'profile_images'))
-ASSISTANT_ICON_PATH = os.path.join(PROFILE_IMAGES_DIR, 'assistant_icon.png')
+# Аватар ассистента (миниатюра из общего кэша аватаров)
+assistant_avatar = get_assistant_avatar()
 
-# Загрузка аватара ассистента
-if os.path.exists(ASSISTANT_ICON_PATH):
-    try:
-        assistant_avatar = Image.open(ASSISTANT_ICON_PATH)
-    except Exception as e:
-        st.error(f"Ошибка при открытии изображения ассистента: {e}")
-        assistant_avatar = "🤖"
-else:
-    assistant_avatar = "🤖"
+# Модель и системное сообщение бесплатного чата; вместе с вопросом образуют ключ кэша ответов
+SIMPLE_CHAT_MODEL = "google/gemini-flash-1.5"
+SIMPLE_CHAT_SYSTEM_PROMPT = "Вы - полезный ассистент. Отвечайте на русском языке."
 
-def get_user_profile_image(username):
-    """Получение изображения профиля польз��вателя"""
-    for ext in ['png', 'jpg', 'jpeg']:
-        image_path = os.path.join(PROFILE_IMAGES_DIR, f"{username}.{ext}")
-        if os.path.exists(image_path):
-            try:
-                return Image.open(image_path)
-            except Exception as e:
-                st.error(f"Ошибка при открытии изображения {image_path}: {e}")
-                return "👤"
-    return "👤"
 
 def get_user_chat_id():
     """Получение уникального идентификатора чата для пользователя"""
@@ -52,6 +35,16 @@ def get_user_chat_id():
     chat_id = hashlib.md5(user_email.encode()).hexdigest()
     return f"chat-{chat_id}"
 
+def get_scheduler_user_key():
+    """Ключ пользователя для планировщика запросов; анонимные сессии ограничиваются по отдельности"""
+    if st.session_state.get("username"):
+        return st.session_state.username
+    if st.session_state.get("email"):
+        return get_user_chat_id()
+    if "anonymous_session_id" not in st.session_state:
+        st.session_state.anonymous_session_id = f"anonymous-{uuid.uuid4().hex}"
+    return st.session_state.anonymous_session_id
+
 def get_user_messages_key():
     """Получение ключа для хранения сообщений конкретного пользователя"""
     user_email = st.session_state.get("email", "")
@@ -59,78 +52,79 @@ def get_user_messages_key():
         return "messages"
     return f"messages_{hashlib.md5(user_email.encode()).hexdigest()}"
 
-def get_api_url():
-    """Получение URL API OpenRouter"""
-    return "https://openrouter.ai/api/v1/chat/completions"
-
 def query(question):
-    """Отправка запроса к API"""
+    """
+    Отправка запроса к API с выводом ответа по мере генерации.
+    Ответы на уже заданные вопросы (в том числе почти совпадающие) берутся из кэша без запроса к API.
+    """
+    cache_params = {"model": SIMPLE_CHAT_MODEL, "system": SIMPLE_CHAT_SYSTEM_PROMPT}
     try:
-        api_url = get_api_url()
-        if not api_url:
-            st.error("API URL не найден в конфигурации")
-            return None
-
-        # Обновленные заголовки
-        headers = {
-            "Authorization": f"Bearer {st.secrets['openrouter']['api_key']}",
-            "HTTP-Referer": "https://github.com/cursor-ai",
-            "X-Title": "Cursor AI Assistant",
-            "Content-Type": "application/json"
-        }
-
-        # Обновляем URL для OpenRouter API
-        api_url = "https://openrouter.ai/api/v1/chat/completions"
-        
-        # Обновленный payload для OpenRouter API
-        payload = {
-            "model": "google/gemini-flash-1.5",
-            "messages": [
-                {
-                    "role": "system",
-                    "content": "Вы - полезный ассистент. Отвечайте на русском языке."
-                },
-                {
-                    "role": "user",
-                    "content": question
-                }
-            ],
-            "max_tokens": 2048,
-            "temperature": 0.7,
-            "top_p": 0.9
+        cached_message = response_cache.get(question, cache_params, near_duplicates=True)
+    except Exception as e:
+        print(f"Ошибка чтения кэша ответов: {str(e)}")
+        cached_message = None
+    
+    if cached_message:
+        with st.chat_message("assistant", avatar=assistant_avatar):
+            st.markdown(cached_message)
+        return {
+            "text": cached_message,
+            "sourceDocuments": [],
+            "cached": True
         }
+    
+    try:
+        messages = [
+            {
+                "role": "system",
+                "content": SIMPLE_CHAT_SYSTEM_PROMPT
+            },
+            {
+                "role": "user",
+                "content": question
+            }
+        ]
         
-        # Отправляем запрос с увеличенным timeout
-        response = requests.post(
-            api_url, 
-            json=payload, 
-            headers=headers, 
-            timeout=60
-        )
+        with st.chat_message("assistant", avatar=assistant_avatar):
+            # Пока запрос ждет свободного места у планировщика, показываем позицию в очереди
+            queue_placeholder = st.empty()
+
+            def show_queue_position(position):
+                if position:
+                    queue_placeholder.info(f"⏳ Запрос в очереди, позиция: {position}")
+                else:
+                    queue_placeholder.empty()
+
+            assistant_message = st.write_stream(stream_chat_completion(
+                messages,
+                model=SIMPLE_CHAT_MODEL,
+                user_key=get_scheduler_user_key(),
+                on_queue=show_queue_position
+            ))
         
-        if response.status_code == 200:
-            response_data = response.json()
-            if 'choices' in response_data and len(response_data['choices']) > 0:
-                assistant_message = response_data['choices'][0]['message']['content']
-                return {
-                    "text": assistant_message,
-                    "sourceDocuments": []
-                }
-            else:
-                st.error("Неожиданный формат ответа от API")
-                return None
-        else:
-            st.error(f"Ошибка API (код {response.status_code}): {response.text}")
-            return None
+        if assistant_message:
+            try:
+                response_cache.put(question, cache_params, assistant_message)
+            except Exception as e:
+                print(f"Ошибка записи в кэш ответов: {str(e)}")
+            return {
+                "text": assistant_message,
+                "sourceDocuments": []
+            }
+        st.error("Неожиданный формат ответа от API")
+        return None
             
+    except LLMAPIError as e:
+        st.error(str(e))
+        return None
     except Exception as e:
         st.error(f"Ошибка при отправке запроса: {str(e)}")
         return None
 
 def count_api_responses():
-    """Подсчет количества ответов от API в истории"""
+    """Подсчет количества ответов от API в истории (ответы из кэша не учитываются)"""
     messages_key = get_user_messages_key()
-    return sum(1 for msg in st.session_state[messages_key] if msg["role"] == "assistant")
+    return sum(1 for msg in st.session_state[messages_key] if msg["role"] == "assistant" and not msg.get("cached"))
 
 def sidebar_content():
     """Содержимое боковой панели"""
@@ -139,7 +133,7 @@ def sidebar_content():
         
         # Отображение информации о пользователе
         if st.session_state.get("email"):
-            user_avatar = get_user_profile_image(st.session_state.get("username", ""))
+            user_avatar = get_user_avatar(st.session_state.get("username", ""))
             col1, col2 = st.columns([1, 3])
             with col1:
                 st.image(user_avatar, width=50)
@@ -160,41 +154,24 @@ def sidebar_content():
             st.session_state[messages_key] = []
             st.rerun()
 
-def translate_text(text, target_lang='ru'):
-    """
-    Переводит текст на указанный я��ык
-    target_lang: 'ru' для русского или 'en' для английского
-    """
-    try:
-        translator = Translator()
-        
-        if text is None or not isinstance(text, str) or text.strip() == '':
-            return "Пустой текст для перевода"
-            
-        # Определяем язык текста
-        detected_lang = translator.detect(text).lang
-        
-        # Если текст уже на целевом языке, меняем язык перевода
-        if detected_lang == target_lang:
-            target_lang = 'en' if target_lang == 'ru' else 'ru'
-            
-        translation = translator.translate(text, dest=target_lang)
-        if translation and hasattr(translation, 'text') and translation.text:
-            return translation.text
-            
-        return f"Ошибка перевода: некорректный ответ от переводчика"
-        
-    except Exception as e:
-        st.error(f"Ошибка при переводе: {str(e)}")
-        return text
+def add_session_message(role, content, cached=False):
+    """Добавляет сообщение в историю сессии, присваивая ему возрастающий id"""
+    messages_key = get_user_messages_key()
+    id_key = f"{messages_key}_next_id"
+    message_id = st.session_state.get(id_key, 1)
+    st.session_state[id_key] = message_id + 1
+    message = {"role": role, "content": content, "id": message_id}
+    if cached:
+        message["cached"] = True
+    st.session_state[messages_key].append(message)
+    return message
 
 def display_message_with_translation(message):
     """Отображает сообщение с кнопкой перевода"""
-    message_hash = get_message_hash(message["role"], message["content"])
-    avatar = assistant_avatar if message["role"] == "assistant" else get_user_profile_image(st.session_state.get("username", ""))
+    avatar = assistant_avatar if message["role"] == "assistant" else get_user_avatar(st.session_state.get("username", ""))
     
     # Инициализируем состояние перевода для этого сообщения
-    translation_key = f"translation_state_{message_hash}"
+    translation_key = f"translation_state_{message['id']}"
     if translation_key not in st.session_state:
         st.session_state[translation_key] = {
             "is_translated": False,
@@ -218,7 +195,7 @@ def display_message_with_translation(message):
             
         # Кнопка перевода во второй колонке
         with cols[1]:
-            if st.button("🔄", key=f"translate_{message_hash}", help="Перевести сообщение"):
+            if st.button("🔄", key=f"translate_{message['id']}", help="Перевести сообщение"):
                 current_state = st.session_state[translation_key]
                 
                 if current_state["is_translated"]:
@@ -234,10 +211,6 @@ def display_message_with_translation(message):
                     message_placeholder.markdown(st.session_state[translation_key]["translated_text"])
                     st.session_state[translation_key]["is_translated"] = True
 
-def get_message_hash(role, content):
-    """Создает уникальный хэш для сообщения"""
-    return hashlib.md5(f"{role}:{content}".encode()).hexdigest()
-
 def main():
     """Основная функция приложения"""
     # Инциализация ключа для сообщений
@@ -265,8 +238,8 @@ def main():
     
     if user_input:
         # Добавляем сообщение пользователя в историю
-        user_message = {"role": "user", "content": user_input}
-        st.session_state[messages_key].append(user_message)
+        user_message = add_session_message("user", user_input)
+        display_message_with_translation(user_message)
         
         # Получаем ответ от API
         with st.spinner("Думаю..."):
@@ -275,8 +248,7 @@ def main():
             if response:
                 full_response = response.get("text", "Извините, произошла ошибка при получении ответа")
                 # Добавление ответа ассистента в историю
-                assistant_message = {"role": "assistant", "content": full_response}
-                st.session_state[messages_key].append(assistant_message)
+                add_session_message("assistant", full_response, cached=response.get("cached", False))
                 st.rerun()  # Перезагружаем страницу для отображения нового сообщения
             else:
                 st.error("Не удалось получить ответ от API")
@@ -1,13 +1,8 @@
-from tinydb import TinyDB, Query
-import hashlib
-import os
+from utils.utils import user_db
 
 def setup_first_admin():
-    db = TinyDB('user_database.json')
-    User = Query()
-    
     # Проверяем существование админа
-    admin = db.search(User.is_admin == True)
+    admin = [user for user in user_db.all() if user.get('is_admin')]
     if admin:
         print("Администратор уже существует")
         return
@@ -28,14 +23,14 @@ def setup_first_admin():
     }
     
     # Проверяем существование пользователя
-    existing_user = db.get(User.username == admin_username)
+    existing_user = user_db.get(admin_username)
     if existing_user:
         # Обновляем существующего пользователя до админа
-        db.update({'is_admin': True}, User.username == admin_username)
+        user_db.update(admin_username, {'is_admin': True})
         print(f"Пользователь {admin_username} повышен до администратора")
     else:
         # Создаем нового администратора
-        db.insert(admin_data)
+        user_db.insert(admin_data)
         print(f"Администратор {admin_username} успешно создан")
 
 if __name__ == "__main__":
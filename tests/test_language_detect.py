@@ -0,0 +1,39 @@
+from utils.language_detect import detect_language, _script_counts, SCRIPT_THRESHOLD
+
+
+def test_russian_reply_with_code_block_is_russian():
+    text = (
+        "Вот пример функции, которая складывает числа:\n"
+        "```python\n"
+        "def add_numbers(first_value, second_value):\n"
+        "    result = first_value + second_value\n"
+        "    print(f'Result is {result}')\n"
+        "    return result\n"
+        "```\n"
+        "Вызовите `add_numbers(2, 3)` и посмотрите https://docs.python.org/3/tutorial/"
+    )
+    assert detect_language(text) == "ru"
+
+
+def test_russian_text_with_inline_identifiers_is_russian():
+    assert detect_language("Используйте функцию print() и def main(): return x + y в Python") == "ru"
+
+
+def test_plain_texts():
+    assert detect_language("Это обычный ответ на русском языке.") == "ru"
+    assert detect_language("This is a regular answer in English.") == "en"
+    assert detect_language("Use the `списки` keyword here: ```x = 'привет мир'```") == "en"
+
+
+def test_mixed_texts_are_scored_by_ngrams():
+    # Ни одна письменность не набирает SCRIPT_THRESHOLD: язык определяют триграммы и служебные слова
+    cases = {
+        "Установите pip install requests и numpy, затем вызовите main": "ru",
+        "Метод append добавляет элемент в конец list, а extend добавляет все элементы iterable": "ru",
+        "In Russian you say спасибо большое to thank someone": "en",
+        "The error says Ошибка подключения к базе данных, check the connection string": "en",
+    }
+    for text, expected in cases.items():
+        cyrillic, latin = _script_counts(text)
+        assert max(cyrillic, latin) < (cyrillic + latin) * SCRIPT_THRESHOLD
+        assert detect_language(text) == expected
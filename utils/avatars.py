@@ -0,0 +1,158 @@
+import io
+import os
+import threading
+from PIL import Image, ImageOps
+from utils.storage_lock import write_atomic, write_queue
+
+PROFILE_IMAGES_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'profile_images'))
+THUMBNAILS_DIR = os.path.join(PROFILE_IMAGES_DIR, 'thumbnails')
+ASSISTANT_ICON_PATH = os.path.join(PROFILE_IMAGES_DIR, 'assistant_icon.png')
+
+# Аватар в чате занимает 32px, миниатюра хранится с запасом для экранов высокой плотности
+THUMBNAIL_SIZE = (64, 64)
+# Фотография профиля хранится уменьшенной и в WebP
+PROFILE_IMAGE_MAX_SIZE = (512, 512)
+PROFILE_IMAGE_QUALITY = 85
+DEFAULT_USER_AVATAR = "👤"
+DEFAULT_ASSISTANT_AVATAR = "🤖"
+
+# Ключ аватара ассистента; аватары пользователей хранятся под ключами user_<имя>,
+# поэтому пользователь с любым именем не подменит аватар ассистента
+ASSISTANT_AVATAR_KEY = "assistant_icon"
+
+# Готовые к отправке в браузер аватары: ключ аватара -> байты PNG или эмодзи
+_avatars = {}
+_avatars_lock = threading.Lock()
+
+if not os.path.exists(THUMBNAILS_DIR):
+    os.makedirs(THUMBNAILS_DIR)
+
+
+def _user_key(username):
+    return f"user_{username}"
+
+
+def _thumbnail_path(key):
+    return os.path.join(THUMBNAILS_DIR, f"{key}.png")
+
+
+def _find_original(username):
+    """Исходное изображение профиля (загрузки до появления миниатюр)"""
+    for ext in ['webp', 'png', 'jpg', 'jpeg']:
+        image_path = os.path.join(PROFILE_IMAGES_DIR, f"{username}.{ext}")
+        if os.path.exists(image_path):
+            return image_path
+    return None
+
+
+def make_thumbnail(image):
+    """Уменьшает изображение до размера аватара и возвращает байты PNG"""
+    thumbnail = image.copy()
+    if thumbnail.mode not in ("RGB", "RGBA"):
+        thumbnail = thumbnail.convert("RGBA")
+    thumbnail.thumbnail(THUMBNAIL_SIZE, Image.LANCZOS)
+    buffer = io.BytesIO()
+    thumbnail.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+
+def _write_thumbnail(name, data):
+    write_atomic(_thumbnail_path(name), data)
+
+
+def save_avatar(username, image):
+    """
+    Создает миниатюру аватара при загрузке фотографии профиля
+    и сразу кладет ее в кэш (старая версия вытесняется).
+    """
+    data = make_thumbnail(image)
+    key = _user_key(username)
+    _write_thumbnail(key, data)
+    with _avatars_lock:
+        _avatars[key] = data
+    return data
+
+
+def _load_avatar(name, original_path, default):
+    """Читает миниатюру с диска; если ее нет - создает из исходного изображения"""
+    thumbnail_path = _thumbnail_path(name)
+    try:
+        if os.path.exists(thumbnail_path):
+            with open(thumbnail_path, "rb") as f:
+                return f.read()
+        if original_path and os.path.exists(original_path):
+            with Image.open(original_path) as image:
+                data = make_thumbnail(image)
+            # Страница не ждет записи миниатюры на диск
+            write_queue.submit(_write_thumbnail, name, data)
+            return data
+    except Exception as e:
+        print(f"Ошибка при загрузке аватара {name}: {e}")
+    return default
+
+
+def get_user_avatar(username):
+    """Аватар пользователя для st.chat_message; после первого обращения - поиск в словаре"""
+    key = _user_key(username)
+    avatar = _avatars.get(key)
+    if avatar is None:
+        avatar = _load_avatar(key, _find_original(username), DEFAULT_USER_AVATAR)
+        with _avatars_lock:
+            avatar = _avatars.setdefault(key, avatar)
+    return avatar
+
+
+def get_assistant_avatar():
+    """Аватар ассистента (общий для всех страниц)"""
+    avatar = _avatars.get(ASSISTANT_AVATAR_KEY)
+    if avatar is None:
+        avatar = _load_avatar(ASSISTANT_AVATAR_KEY, ASSISTANT_ICON_PATH, DEFAULT_ASSISTANT_AVATAR)
+        with _avatars_lock:
+            avatar = _avatars.setdefault(ASSISTANT_AVATAR_KEY, avatar)
+    return avatar
+
+
+def invalidate_avatar(username, remove_thumbnail=True):
+    """Сбрасывает аватар пользователя (удаление или замена фото, смена имени)"""
+    key = _user_key(username)
+    with _avatars_lock:
+        _avatars.pop(key, None)
+    if remove_thumbnail:
+        try:
+            os.remove(_thumbnail_path(key))
+        except FileNotFoundError:
+            pass
+
+
+def process_profile_image(data, username):
+    """
+    Обрабатывает загруженную фотографию профиля: декодирует один раз,
+    поворачивает по EXIF и отбрасывает метаданные, уменьшает до PROFILE_IMAGE_MAX_SIZE,
+    сохраняет в WebP и создает миниатюру аватара. Возвращает путь к файлу.
+    Выбрасывает исключение, если данные не являются изображением.
+    """
+    with Image.open(io.BytesIO(data)) as source:
+        # Для JPEG декодер сразу уменьшает изображение, не распаковывая его целиком
+        source.draft("RGB", PROFILE_IMAGE_MAX_SIZE)
+        image = ImageOps.exif_transpose(source)
+        image.load()
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "transparency" in image.info or image.mode in ("LA", "PA") else "RGB")
+    image.thumbnail(PROFILE_IMAGE_MAX_SIZE, Image.LANCZOS)
+
+    # EXIF и прочие метаданные не передаются при сохранении
+    buffer = io.BytesIO()
+    image.save(buffer, format="WEBP", quality=PROFILE_IMAGE_QUALITY, method=4, exif=b"")
+    image_path = os.path.join(PROFILE_IMAGES_DIR, f"{username}.webp")
+    write_atomic(image_path, buffer.getvalue())
+
+    # Загрузки в прежних форматах больше не нужны
+    for ext in ['png', 'jpg', 'jpeg']:
+        old_path = os.path.join(PROFILE_IMAGES_DIR, f"{username}.{ext}")
+        # Исходный значок ассистента лежит в том же каталоге и не удаляется
+        if old_path != ASSISTANT_ICON_PATH and os.path.exists(old_path):
+            os.remove(old_path)
+
+    save_avatar(username, image)
+    return image_path
+
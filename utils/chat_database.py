@@ -1,36 +1,200 @@
-from tinydb import TinyDB, Query
 import os
 from datetime import datetime
-from utils.utils import get_data_file_path
-import hashlib
+from utils.chat_storage import DEFAULT_CHAT_STORAGE
+from utils.context_window import estimate_tokens
+from utils.chat_index import ChatIndex
+from utils.history_cache import history_cache
+from utils.storage_lock import file_lock
 
-def get_message_hash(role, content):
-    """Создает уникальный хэш для сообщения"""
-    return hashlib.md5(f"{role}:{content}".encode()).hexdigest()
+class HistorySnapshot:
+    """Снимок истории чата с заранее посчитанными позициями сообщений"""
+
+    def __init__(self, messages):
+        self.messages = []
+        self.position_by_id = {}
+        for message in messages:
+            self.add(message)
+
+    def add(self, message):
+        """
+        Добавляет сообщение в конец снимка; возвращает False, если сообщение с таким id уже есть
+        (снимок загружен из файла, в который это сообщение уже было записано)
+        """
+        if message["id"] in self.position_by_id:
+            return False
+        self.messages.append(message)
+        self.position_by_id[message["id"]] = len(self.messages)
+        return True
+
+    def position(self, message_id):
+        """Возвращает номер сообщения с данным id в истории (с единицы) или None"""
+        return self.position_by_id.get(message_id)
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def __len__(self):
+        return len(self.messages)
 
 class ChatDatabase:
-    def __init__(self, chat_id):
-        self.db = TinyDB(get_data_file_path(f'chat_history_{chat_id}.json'))
-        
+    def __init__(self, chat_id, storage_cls=None):
+        self.chat_id = chat_id
+        # Хранилище можно подменить (например, TinyDBChatStorage для старых файлов)
+        self.storage = (storage_cls or DEFAULT_CHAT_STORAGE)(chat_id)
+        # Ключ общего кэша историй - файл хранилища
+        self.cache_key = self.storage.path
+        # Поисковый индекс сообщений хранится рядом с файлом истории
+        self.index = ChatIndex(self.storage.path)
+        # Снимок истории, которая слишком велика для общего кэша (на время жизни экземпляра)
+        self._snapshot = None
+
+    def _signature(self):
+        """Подпись файла истории: меняется при любой записи в него"""
+        try:
+            stat = os.stat(self.storage.path)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _cached_snapshot(self):
+        """
+        Снимок истории из общего кэша процесса. При промахе история загружается,
+        если она помещается в кэш; иначе возвращается None и чтение идет окнами из файла.
+        """
+        if self._snapshot is not None:
+            return self._snapshot
+        # Подпись берется до чтения: запись, случившаяся во время чтения, сделает запись устаревшей
+        signature = self._signature()
+        snapshot = history_cache.get(self.cache_key, signature)
+        if snapshot is None and (signature is None or history_cache.fits(signature[2])):
+            snapshot = HistorySnapshot(self.storage.all())
+            # Файл дописали во время чтения: снимок верен, но взятая до чтения подпись к нему не относится
+            if self._signature() == signature:
+                history_cache.put(self.cache_key, snapshot, signature)
+        return snapshot
+
     def add_message(self, role, content):
-        self.db.insert({
+        """Сохраняет сообщение и возвращает его id (возрастающий номер внутри чата)"""
+        message = {
             'role': role,
             'content': content,
-            'timestamp': datetime.now().isoformat()
-        })
-        
+            'timestamp': datetime.now().isoformat(),
+            # Оценка токенов считается один раз при сохранении и используется при сборке промпта
+            'tokens': estimate_tokens(content)
+        }
+        # Запись и обновление кэша под одной блокировкой: порядок в кэше совпадает с файлом
+        with file_lock(self.storage.path):
+            previous_signature = self._signature()
+            message_id = self.storage.append(message)
+            message = dict(message, id=message_id)
+            history_cache.append(self.cache_key, message, previous_signature, self._signature())
+            self.index.add(message)
+        if self._snapshot is not None:
+            self._snapshot.add(message)
+        return message_id
+
+    def add_message_once(self, role, content):
+        """
+        Сохраняет сообщение, если оно не повторяет последнее сообщение чата
+        (двойное нажатие "Отправить", повтор вопроса после ошибки).
+        Возвращает (сообщение с id, было ли оно добавлено).
+        """
+        last_message = self.tail(1)
+        if last_message and last_message[0]['role'] == role and last_message[0]['content'] == content:
+            return last_message[0], False
+        message_id = self.add_message(role, content)
+        return {'role': role, 'content': content, 'id': message_id, 'tokens': estimate_tokens(content)}, True
+
+    def message_key(self, message):
+        """Ключ сообщения для виджетов и состояния страницы: уникален для всех чатов сессии"""
+        return f"{self.chat_id}_{message['id']}"
+
     def get_history(self):
-        return self.db.all()
-        
+        return list(self.snapshot())
+
+    def tail(self, n):
+        """Последние n сообщений без загрузки всей истории"""
+        snapshot = self._cached_snapshot()
+        if snapshot is not None:
+            return snapshot.messages[-n:] if n > 0 else []
+        return self.storage.tail(n)
+
+    def range(self, start, end):
+        """Сообщения history[start:end] без загрузки всей истории"""
+        snapshot = self._cached_snapshot()
+        if snapshot is not None:
+            return snapshot.messages[start:end]
+        return self.storage.range(start, end)
+
+    def count(self):
+        snapshot = self._cached_snapshot()
+        if snapshot is not None:
+            return len(snapshot)
+        return self.storage.count()
+
+    def snapshot(self):
+        """
+        Снимок истории. Истории разумного размера берутся из общего для процесса кэша,
+        поэтому повторные прогоны скрипта не читают файл; большие загружаются
+        один раз на экземпляр базы.
+        """
+        snapshot = self._cached_snapshot()
+        if snapshot is None:
+            snapshot = self._snapshot = HistorySnapshot(self.storage.all())
+        return snapshot
+
+    def _write_through(self, messages):
+        """Кладет в кэш историю после изменения (удаления, правки, очистки)"""
+        self._snapshot = None
+        if messages is None:
+            history_cache.invalidate(self.cache_key)
+        else:
+            history_cache.put(self.cache_key, HistorySnapshot(messages), self._signature())
+
+    def _cached_messages(self):
+        snapshot = history_cache.get(self.cache_key, self._signature())
+        return None if snapshot is None else snapshot.messages
+
     def clear_history(self):
-        self.db.truncate()
-        
-    def delete_message(self, message_hash):
-        """Удаляет конкретное сообщение из истории чата по его хэшу"""
-        history = self.get_history()
-        updated_history = [msg for msg in history if get_message_hash(msg["role"], msg["content"]) != message_hash]
-        # Очищаем базу
-        self.db.truncate()
-        # Вставляем обновленную историю
-        for msg in updated_history:
-            self.db.insert(msg)
\ No newline at end of file
+        with file_lock(self.storage.path):
+            self.storage.clear()
+            self.index.invalidate()
+            self._write_through([])
+
+    def delete_message(self, message_id):
+        """Удаляет сообщение по его id"""
+        self.delete_messages([message_id])
+
+    def delete_messages(self, message_ids):
+        """Удаляет несколько сообщений одной записью в хранилище"""
+        with file_lock(self.storage.path):
+            messages = self._cached_messages()
+            self.storage.delete(message_ids)
+            self.index.invalidate()
+            if messages is not None:
+                removed = set(message_ids)
+                messages = [msg for msg in messages if msg['id'] not in removed]
+            self._write_through(messages)
+
+    def edit_message(self, message_id, content):
+        """Заменяет текст сообщения, сохраняя его id и позицию"""
+        with file_lock(self.storage.path):
+            messages = self._cached_messages()
+            fields = {'content': content, 'tokens': estimate_tokens(content)}
+            self.storage.edit(message_id, fields)
+            self.index.invalidate()
+            if messages is not None:
+                messages = [dict(msg, **fields) if msg['id'] == message_id else msg for msg in messages]
+            self._write_through(messages)
+
+    def search(self, query, k=5, exclude_ids=()):
+        """
+        Сообщения чата, наиболее релевантные запросу (до k штук, в хронологическом порядке).
+        Поиск локальный, по индексу частот слов, без обращения к модели.
+        """
+        return self.index.search(self.snapshot().messages, query, k, exclude_ids)
+
+    def truncate_after(self, index):
+        """Оставляет первые index сообщений и удаляет все последующие"""
+        history = self.snapshot().messages
+        self.delete_messages([msg["id"] for msg in history[index:]])
@@ -0,0 +1,144 @@
+import os
+import re
+import zlib
+import numpy as np
+from utils.storage_lock import file_lock, write_atomic
+
+# Размерность хэшированного словаря: столбец матрицы - хэш основы слова
+INDEX_DIM = 2048
+# Грубая основа слова: не длиннее STEM_LENGTH и без двух последних букв (окончание),
+# но не короче MIN_STEM_LENGTH. Сводит вместе формы одного слова ("борщ", "борща", "борщом")
+STEM_LENGTH = 6
+MIN_STEM_LENGTH = 4
+# Параметры ранжирования BM25
+BM25_K1 = 1.5
+BM25_B = 0.75
+# Запись индекса: пара (сообщение, термин) с частотой термина (больше 255 повторов не различаются).
+# Сообщение без терминов записывается одной парой с нулевой частотой, чтобы его id был в индексе
+RECORD_DTYPE = np.dtype([("id", "<i8"), ("column", "<u2"), ("tf", "u1")])
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def tokenize(text):
+    words = _WORD_RE.findall(text.lower().replace("ё", "е"))
+    return [word[:max(MIN_STEM_LENGTH, min(STEM_LENGTH, len(word) - 2))] for word in words if len(word) > 1]
+
+
+def _term_column(term):
+    # crc32, а не hash(): столбцы должны совпадать между процессами и перезапусками
+    return zlib.crc32(term.encode("utf-8")) % INDEX_DIM
+
+
+def vectorize(text):
+    """Частоты терминов текста в хэшированном словаре: (столбцы по возрастанию, частоты)"""
+    columns, counts = np.unique([_term_column(term) for term in tokenize(text)], return_counts=True)
+    return columns.astype(np.uint16), np.minimum(counts, 255).astype(np.uint8)
+
+
+class ChatIndex:
+    """
+    Поисковый индекс истории чата: разреженная матрица частот терминов (пары сообщение-термин
+    в порядке сообщений), хранящаяся в файле рядом с историей. Новое сообщение дописывает в файл свои пары;
+    после удаления, правки или очистки индекс удаляется и перестраивается при следующем поиске.
+    Записи идут под блокировкой файла истории.
+    """
+
+    def __init__(self, chat_path):
+        self.chat_path = chat_path
+        self.path = f"{chat_path}.index"
+
+    @staticmethod
+    def _encode(messages):
+        parts = []
+        for message in messages:
+            columns, counts = vectorize(message["content"])
+            if not columns.size:
+                columns, counts = np.zeros(1, dtype=np.uint16), np.zeros(1, dtype=np.uint8)
+            records = np.empty(columns.size, dtype=RECORD_DTYPE)
+            records["id"] = message["id"]
+            records["column"] = columns
+            records["tf"] = counts
+            parts.append(records)
+        if not parts:
+            return b""
+        return np.concatenate(parts).tobytes()
+
+    def add(self, message):
+        """Дописывает сообщение в индекс, если он уже построен (вызывается под блокировкой истории)"""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "ab") as f:
+                f.write(self._encode([message]))
+        except OSError as e:
+            print(f"Ошибка обновления индекса {self.path}: {str(e)}")
+            self.invalidate()
+
+    def invalidate(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _rows(records):
+        """Номер сообщения (строки матрицы) для каждой пары и id сообщений по порядку"""
+        starts = np.ones(len(records), dtype=bool)
+        starts[1:] = records["id"][1:] != records["id"][:-1]
+        return np.cumsum(starts) - 1, records["id"][starts]
+
+    def _load(self, message_ids):
+        """Пары из файла и номера их строк, если индекс соответствует текущему списку сообщений"""
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return None
+        # Оборванная запись или индекс в другом формате
+        if size % RECORD_DTYPE.itemsize:
+            return None
+        records = np.fromfile(self.path, dtype=RECORD_DTYPE)
+        rows, ids = self._rows(records)
+        if not np.array_equal(ids, message_ids):
+            return None
+        return records, rows
+
+    def _rebuild(self, messages):
+        data = self._encode(messages)
+        with file_lock(self.chat_path):
+            write_atomic(self.path, data)
+        records = np.frombuffer(data, dtype=RECORD_DTYPE)
+        return records, self._rows(records)[0]
+
+    def search(self, messages, query, k, exclude_ids=()):
+        """
+        Возвращает до k сообщений из messages (текущая история чата), наиболее релевантных
+        запросу по BM25, в хронологическом порядке. Сообщения без общих с запросом слов не возвращаются.
+        """
+        columns = np.unique([_term_column(term) for term in tokenize(query)])
+        if not messages or not columns.size or k <= 0:
+            return []
+
+        message_ids = np.array([message["id"] for message in messages], dtype=np.int64)
+        loaded = self._load(message_ids)
+        records, rows = loaded if loaded is not None else self._rebuild(messages)
+
+        doc_len = np.bincount(rows, weights=records["tf"], minlength=len(messages))
+        avg_len = max(float(doc_len.mean()), 1.0)
+        # Пары с терминами запроса: у сообщения не больше одной пары на столбец
+        matched = np.flatnonzero(np.isin(records["column"], columns) & (records["tf"] > 0))
+        term = np.searchsorted(columns, records["column"][matched])
+        tf = records["tf"][matched].astype(np.float32)
+        rows = rows[matched]
+        df = np.bincount(term, minlength=columns.size)
+        idf = np.log(1 + (len(messages) - df + 0.5) / (df + 0.5))
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_len[rows] / avg_len)
+        scores = np.bincount(rows, weights=idf[term] * tf * (BM25_K1 + 1) / (tf + norm),
+                             minlength=len(messages))
+        if exclude_ids:
+            scores[np.isin(message_ids, list(exclude_ids))] = 0
+
+        candidates = np.flatnonzero(scores > 0)
+        if candidates.size > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        return [messages[i] for i in sorted(candidates)]
@@ -0,0 +1,407 @@
+import json
+import os
+import threading
+import uuid
+from utils.utils import get_data_file_path
+from utils.storage_lock import file_lock, write_atomic
+
+# Минимальное количество "мертвых" записей в логе, после которого запускается компактизация
+COMPACT_MIN_GARBAGE = 64
+# Размер блока при чтении лога с конца
+REVERSE_READ_BLOCK = 8192
+
+
+def _iter_lines_reverse(f, block_size=REVERSE_READ_BLOCK):
+    """Построчно читает бинарный файл с конца, не загружая его целиком"""
+    f.seek(0, os.SEEK_END)
+    position = f.tell()
+    remainder = b""
+    while position > 0:
+        read_size = min(block_size, position)
+        position -= read_size
+        f.seek(position)
+        chunk = f.read(read_size) + remainder
+        lines = chunk.split(b"\n")
+        remainder = lines.pop(0)
+        for line in reversed(lines):
+            if line.strip():
+                yield line
+    if remainder.strip():
+        yield remainder
+
+
+def _decode_record(line):
+    """Разбирает одну запись лога, пропуская поврежденные строки"""
+    try:
+        return json.loads(line)
+    except (ValueError, UnicodeDecodeError):
+        print(f"Пропущена поврежденная запись лога: {line[:80]!r}")
+        return None
+
+
+def _encode_record(record):
+    return (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def _meta_record(next_id):
+    """Служебная запись в начале лога; generation отличает каждую перезапись файла"""
+    return {"op": "meta", "next_id": next_id, "generation": uuid.uuid4().hex}
+
+
+def _merge_edits(record, edits):
+    """Применяет записи редактирования (в хронологическом порядке) к сообщению"""
+    for fields in edits:
+        record = dict(record, **fields)
+    return record
+
+
+class _OffsetIndex:
+    """
+    Индекс смещений сообщений в логе: порядок живых id и позиции их записей в файле.
+    Индекс дочитывается инкрементально - при росте файла разбираются только новые байты.
+    Замененный файл (компактизация, очистка) распознается по первой строке: служебная
+    запись meta в начале лога получает новый generation при каждой перезаписи.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._reset(None)
+
+    def _reset(self, inode, header=None):
+        self.inode = inode
+        self.header = header
+        self.size = 0
+        self.ids = []
+        self.offsets = {}
+        self.edit_offsets = {}
+
+    def invalidate(self):
+        with self.lock:
+            self._reset(None)
+
+    def refresh(self, f):
+        """Обновляет индекс по открытому файлу лога"""
+        stat = os.fstat(f.fileno())
+        f.seek(0)
+        header = f.readline()
+        # Компактизация и очистка заменяют файл - индекс строится заново.
+        # Новый файл может получить тот же inode и вырасти больше старого, поэтому
+        # сравнивается и первая строка (meta с generation)
+        if stat.st_ino != self.inode or stat.st_size < self.size or header != self.header:
+            self._reset(stat.st_ino, header)
+        if stat.st_size == self.size:
+            return
+        deleted = set()
+        f.seek(self.size)
+        offset = self.size
+        for line in f:
+            if not line.endswith(b"\n"):
+                # Недописанная запись - дочитаем при следующем обновлении
+                break
+            record = _decode_record(line) if line.strip() else None
+            if record is not None:
+                op = record.get("op")
+                if op == "delete":
+                    for message_id in record.get("ids", []):
+                        if self.offsets.pop(message_id, None) is not None:
+                            deleted.add(message_id)
+                        self.edit_offsets.pop(message_id, None)
+                elif op == "edit":
+                    if record["id"] in self.offsets:
+                        self.edit_offsets.setdefault(record["id"], []).append(offset)
+                elif op is None:
+                    self.ids.append(record["id"])
+                    self.offsets[record["id"]] = offset
+            offset += len(line)
+        self.size = offset
+        if deleted:
+            self.ids = [message_id for message_id in self.ids if message_id not in deleted]
+
+
+_offset_indexes = {}
+_offset_indexes_lock = threading.Lock()
+
+
+def _get_offset_index(path):
+    with _offset_indexes_lock:
+        if path not in _offset_indexes:
+            _offset_indexes[path] = _OffsetIndex()
+        return _offset_indexes[path]
+
+
+def _atomic_json_storage():
+    """Хранилище TinyDB, которое перезаписывает файл атомарно (читатели не видят его частично)"""
+    from tinydb.storages import Storage
+
+    class AtomicJSONStorage(Storage):
+        def __init__(self, path):
+            self.path = path
+
+        def read(self):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    content = f.read()
+            except FileNotFoundError:
+                return None
+            return json.loads(content) if content.strip() else None
+
+        def write(self, data):
+            write_atomic(self.path, json.dumps(data, ensure_ascii=False).encode("utf-8"))
+
+    return AtomicJSONStorage
+
+
+class TinyDBChatStorage:
+    """Хранилище истории на стандартном JSON-хранилище TinyDB (перезаписывает файл при каждой вставке)"""
+
+    def __init__(self, chat_id):
+        from tinydb import TinyDB
+        self.path = get_data_file_path(f'chat_history_{chat_id}.json')
+        self.db = TinyDB(self.path, storage=_atomic_json_storage())
+
+    def append(self, message):
+        with file_lock(self.path):
+            # Таблица запоминает следующий id; другой экземпляр мог уже дописать файл
+            self.db.table(self.db.default_table_name)._next_id = None
+            return self.db.insert(message)
+
+    def all(self):
+        return [dict(doc, id=doc.doc_id) for doc in self.db.all()]
+
+    # TinyDB не умеет читать файл частично, поэтому окна считаются по полной истории
+    def tail(self, n):
+        return self.all()[-n:] if n > 0 else []
+
+    def range(self, start, end):
+        return self.all()[start:end]
+
+    def count(self):
+        return len(self.db)
+
+    def delete(self, ids):
+        ids = list(ids)
+        if ids:
+            with file_lock(self.path):
+                self.db.remove(doc_ids=ids)
+
+    def edit(self, message_id, fields):
+        with file_lock(self.path):
+            self.db.update(fields, doc_ids=[message_id])
+
+    def clear(self):
+        with file_lock(self.path):
+            self.db.truncate()
+
+
+class JsonlChatStorage:
+    """
+    Хранилище истории в виде append-only лога (одна JSON-запись на строку).
+    Вставка дописывает одну строку в конец файла, удаление и редактирование -
+    одну служебную запись, поэтому любая операция выполняется одной записью в файл.
+    Накопившиеся удаленные записи периодически вычищаются компактизацией.
+    """
+
+    def __init__(self, chat_id):
+        self.path = get_data_file_path(f'chat_history_{chat_id}.jsonl')
+        legacy_path = get_data_file_path(f'chat_history_{chat_id}.json')
+        if not os.path.exists(self.path) and os.path.exists(legacy_path):
+            with file_lock(self.path):
+                # Другая сессия могла перенести историю, пока мы ждали блокировку
+                if not os.path.exists(self.path):
+                    migrate_tinydb_history(legacy_path, self.path)
+
+    def _next_id(self):
+        """Определяет следующий id по последним записям лога"""
+        if not os.path.exists(self.path):
+            return 1
+        max_seen = 0
+        with open(self.path, "rb") as f:
+            for line in _iter_lines_reverse(f):
+                record = _decode_record(line)
+                if record is None:
+                    continue
+                op = record.get("op")
+                if op == "delete":
+                    max_seen = max([max_seen] + record.get("ids", []))
+                elif op == "edit":
+                    max_seen = max(max_seen, record["id"])
+                elif op == "meta":
+                    return max(record.get("next_id", 1), max_seen + 1)
+                elif op is None:
+                    return max(record["id"], max_seen) + 1
+        return max_seen + 1
+
+    def _append_records(self, *records):
+        data = b"".join(_encode_record(record) for record in records)
+        with open(self.path, "ab+") as f:
+            # Если предыдущая запись была оборвана, начинаем с новой строки
+            f.seek(0, os.SEEK_END)
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    data = b"\n" + data
+            f.write(data)
+
+    def _replay(self):
+        """Восстанавливает актуальное состояние истории из лога"""
+        messages = {}
+        next_id = 1
+        total_records = 0
+        if not os.path.exists(self.path):
+            return messages, next_id, total_records
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = _decode_record(line)
+                if record is None:
+                    continue
+                total_records += 1
+                op = record.get("op")
+                if op == "meta":
+                    next_id = max(next_id, record.get("next_id", 1))
+                elif op == "delete":
+                    for message_id in record.get("ids", []):
+                        messages.pop(message_id, None)
+                        next_id = max(next_id, message_id + 1)
+                elif op == "edit":
+                    if record["id"] in messages:
+                        messages[record["id"]] = dict(messages[record["id"]], **record["fields"])
+                elif op is None:
+                    messages[record["id"]] = record
+                    next_id = max(next_id, record["id"] + 1)
+        return messages, next_id, total_records
+
+    # Все записи в лог идут под блокировкой файла: выбор id и дозапись не должны
+    # перемежаться с другими писателями, а компактизация - терять их записи.
+    # Чтение блокировку не берет: лог только дописывается или атомарно заменяется.
+
+    def append(self, message):
+        with file_lock(self.path):
+            message_id = self._next_id()
+            self._append_records(dict(message, id=message_id))
+        return message_id
+
+    def all(self):
+        messages, next_id, total_records = self._replay()
+        garbage = total_records - len(messages)
+        if garbage >= COMPACT_MIN_GARBAGE and garbage > len(messages):
+            with file_lock(self.path):
+                # Под блокировкой перечитываем лог: его могли дописать после чтения
+                messages, next_id, _ = self._replay()
+                self._compact(messages, next_id)
+        return list(messages.values())
+
+    def tail(self, n):
+        """Последние n сообщений: лог читается с конца до тех пор, пока их не наберется n"""
+        if n <= 0 or not os.path.exists(self.path):
+            return []
+        collected = []
+        deleted = set()
+        edits = {}
+        with open(self.path, "rb") as f:
+            for line in _iter_lines_reverse(f):
+                record = _decode_record(line)
+                if record is None:
+                    continue
+                op = record.get("op")
+                if op == "delete":
+                    deleted.update(record.get("ids", []))
+                elif op == "edit":
+                    edits.setdefault(record["id"], []).append(record["fields"])
+                elif op is None and record["id"] not in deleted:
+                    collected.append(_merge_edits(record, reversed(edits.get(record["id"], []))))
+                    if len(collected) >= n:
+                        break
+        collected.reverse()
+        return collected
+
+    def range(self, start, end):
+        """Сообщения history[start:end]: читаются только нужные записи по индексу смещений"""
+        messages = []
+        if not os.path.exists(self.path):
+            return messages
+        index = _get_offset_index(self.path)
+        # Индекс и чтение записей используют один дескриптор, поэтому
+        # одновременная компактизация не сдвинет смещения под нами
+        with open(self.path, "rb") as f:
+            with index.lock:
+                index.refresh(f)
+                ids = index.ids[start:end]
+                locations = [(index.offsets[message_id], list(index.edit_offsets.get(message_id, []))) for message_id in ids]
+            for offset, edit_offsets in locations:
+                f.seek(offset)
+                record = json.loads(f.readline())
+                edits = []
+                for edit_offset in edit_offsets:
+                    f.seek(edit_offset)
+                    edits.append(json.loads(f.readline())["fields"])
+                messages.append(_merge_edits(record, edits))
+        return messages
+
+    def count(self):
+        if not os.path.exists(self.path):
+            return 0
+        index = _get_offset_index(self.path)
+        with open(self.path, "rb") as f:
+            with index.lock:
+                index.refresh(f)
+                return len(index.ids)
+
+    def delete(self, ids):
+        ids = list(ids)
+        if ids:
+            with file_lock(self.path):
+                self._append_records({"op": "delete", "ids": ids})
+
+    def edit(self, message_id, fields):
+        with file_lock(self.path):
+            self._append_records({"op": "edit", "id": message_id, "fields": fields})
+
+    def clear(self):
+        with file_lock(self.path):
+            # Сохраняем счетчик id, чтобы идентификаторы не переиспользовались
+            self._compact({}, self._next_id())
+
+    def compact(self):
+        """Переписывает лог, оставляя только актуальные сообщения"""
+        with file_lock(self.path):
+            messages, next_id, _ = self._replay()
+            self._compact(messages, next_id)
+
+    def _compact(self, messages, next_id):
+        records = [_meta_record(next_id)] + list(messages.values())
+        write_atomic(self.path, b"".join(_encode_record(record) for record in records))
+        _get_offset_index(self.path).invalidate()
+
+
+def migrate_tinydb_history(json_path, jsonl_path=None):
+    """
+    Переносит историю чата из файла TinyDB в append-only лог.
+    Идентификаторы документов TinyDB сохраняются как id сообщений.
+    Возвращает количество перенесенных сообщений.
+    """
+    if jsonl_path is None:
+        jsonl_path = os.path.splitext(json_path)[0] + ".jsonl"
+    try:
+        with open(json_path, "r", encoding="utf-8") as f:
+            content = f.read()
+        data = json.loads(content) if content.strip() else {}
+    except Exception as e:
+        print(f"Ошибка чтения истории {json_path}: {str(e)}")
+        return 0
+
+    table = data.get("_default", {})
+    records = []
+    for doc_id in sorted(table, key=int):
+        records.append(dict(table[doc_id], id=int(doc_id)))
+    next_id = records[-1]["id"] + 1 if records else 1
+
+    payload = [_meta_record(next_id)] + records
+    with file_lock(jsonl_path):
+        write_atomic(jsonl_path, b"".join(_encode_record(record) for record in payload))
+    return len(records)
+
+
+# Хранилище, используемое ChatDatabase по умолчанию
+DEFAULT_CHAT_STORAGE = JsonlChatStorage
@@ -2,12 +2,15 @@ import os
 import streamlit as st
 from typing import Optional, List, Dict
 import requests
-import json
 from functools import lru_cache
 from utils.chat_database import ChatDatabase
-from tinydb import TinyDB, Query
+from utils.llm_client import chat_completion, LLMAPIError
+from utils.utils import summary_cache
 import time
 
+# Сколько наиболее релевантных вопросу сообщений чата попадает в контекст
+RELEVANT_CONTEXT_K = 5
+
 @lru_cache()
 def initialize_openrouter_api() -> Optional[str]:
     """Инициализация OpenRouter API с обработкой ошибок"""
@@ -20,123 +23,149 @@ def initialize_openrouter_api() -> Optional[str]:
         print(f"Ошибка при инициализации OpenRouter API: {e}")
         return None
 
+def format_history(messages):
+    """Форматирует сообщения в текст диалога для промпта"""
+    formatted_history = []
+    for msg in messages:
+        role = "Assistant" if msg['role'] == "assistant" else "User"
+        formatted_history.append(f"{role}: {msg['content']}")
+    return "\n".join(formatted_history)
+
 class ContextManager:
     def __init__(self):
         """Инициализация менеджера контекста с обработкой ошибок"""
         self.openrouter_api_key = initialize_openrouter_api()
         self.default_context = "Вы - профессиональный бизнес-консультант."
+        # Общий для процесса кэш: таблица создается один раз, а не при каждом прогоне страницы
+        self.summary_cache = summary_cache
+
+    def _request_summary(self, prompt, chat_db_name):
+        """Запрос сводки к модели с повторными попытками при сетевых ошибках"""
+        max_retries = 3
+        retry_delay = 2
+        
+        for attempt in range(max_retries):
+            try:
+                return chat_completion(
+                    [
+                        {
+                            "role": "user",
+                            "content": prompt
+                        }
+                    ],
+                    model="google/gemini-flash-1.5",
+                    max_tokens=2048,
+                    temperature=0.2,
+                    top_p=0.9,
+                    n=1
+                ).strip()
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if attempt < max_retries - 1:
+                    print(f"Попытка {attempt + 1} не удалась для чата {chat_db_name}: {str(e)}")
+                    time.sleep(retry_delay)
+                else:
+                    print(f"Все попытки исчерпаны для чата {chat_db_name}")
+            except LLMAPIError:
+                print(f"Неожиданный формат ответа для чата {chat_db_name}")
+                return None
+        return None
 
-    def get_context(self, username, message, flow_id=None, context_range=(1, 10)):
+    def get_summary(self, chat_db_name, history, start_idx):
         """
-        Получает контекст для сообщения на основе истории конкретного чата
-        с учетом указанного диапазона сообщений
+        Возвращает сводку сообщений history (начинающихся с позиции start_idx).
+        Сводка берется из кэша; если с момента ее создания добавились сообщения,
+        к модели отправляется только прирост вместе с предыдущей сводкой.
         """
-        chat_db_name = f"{username}_{flow_id}" if flow_id else f"{username}_main_chat"
-        chat_db = ChatDatabase(chat_db_name)
-        history = chat_db.get_history()
+        end_idx = start_idx + len(history)
+        cached = self.summary_cache.get(chat_db_name, start_idx)
         
-        if not history:
-            return message
+        # Кэш актуален, если на его последней позиции все еще то же сообщение
+        if cached and start_idx < cached["end_idx"] <= end_idx:
+            covered_message = history[cached["end_idx"] - start_idx - 1]
+            if covered_message.get("id") != cached["last_message_id"]:
+                cached = None
+        else:
+            cached = None
         
-        try:
-            # Получаем сообщения из указанного диапазона
-            start_idx = max(0, context_range[0] - 1)
-            end_idx = min(len(history), context_range[1])
-            
-            # Форматируем только сообщения из выбранного диапазона
-            formatted_history = []
-            for msg in history[start_idx:end_idx]:
-                role = "Assistant" if msg['role'] == "assistant" else "User"
-                formatted_history.append(f"{role}: {msg['content']}")
-            
-            history_text = "\n".join(formatted_history)
-            
+        if cached and cached["end_idx"] == end_idx:
+            print(f"Сводка для чата {chat_db_name} взята из кэша")
+            return cached["summary"]
+        
+        if cached:
+            new_messages = history[cached["end_idx"] - start_idx:]
+            print(f"Обновление сводки для чата {chat_db_name}: новых сообщений {len(new_messages)}")
+            prompt = f"""[INST] Ты - профессиональный ассистент с отличной памятью.
+Ниже приведена сводка предыдущей части диалога и новые сообщения.
+Дополни сводку новыми сообщениями, сохранив важные детали из нее.
+
+Текущая сводка:
+{cached["summary"]}
+
+Новые сообщения:
+{format_history(new_messages)}
+
+Верни только обновленную сводку.
+[/INST]"""
+        else:
             print(f"Анализ истории для чата {chat_db_name}")
-            
-            # Обновленный промпт для анализа контекста
-            context_prompt = f"""[INST] Ты - профессиональный ассистент с отличной памятью. 
-            Твоя задача - проанализировать историю диалога и создать релевантный контекст для нового вопроса.
+            prompt = f"""[INST] Ты - профессиональный ассистент с отличной памятью.
+Твоя задача - составить сводку истории диалога, которая поможет отвечать на следующие вопросы.
 
 История текущего чата:
-{history_text}
-
-Новый вопрос пользователя:
-{message}
+{format_history(history)}
 
-Проанализируй и создай контекст, учитывая:
-1. Ключевые темы и концепции из предыдущих сообщений
+Составь сводку, учитывая:
+1. Ключевые темы и концепции из сообщений
 2. Важные детали и факты, упомянутые ранее
-3. Связи между текущим вопросом и предыдущим контекстом
-4. Релевантную информацию для формирования ответа
-5. Последовательность развития диалога
-
-Сформируй структурированный ответ, который поможет дать наиболее точный и контекстно-зависимый ответ на новый вопрос.
+3. Принятые решения и открытые вопросы
+4. Последовательность развития диалога
 [/INST]"""
+        
+        summary = self._request_summary(prompt, chat_db_name)
+        if summary:
+            self.summary_cache.put(chat_db_name, start_idx, end_idx, history[-1].get("id", 0), summary)
+        return summary
 
-            # Добавляем повторные попытки при сетевых ошибках
-            max_retries = 3
-            retry_delay = 2
+    def get_context(self, username, message, flow_id=None, context_range=(1, 10), relevant_k=RELEVANT_CONTEXT_K):
+        """
+        Получает контекст для сообщения на основе истории конкретного чата.
+        По умолчанию в контекст попадают relevant_k сообщений, наиболее близких к вопросу
+        (локальный поиск по индексу чата, без запроса к модели). При relevant_k=None
+        контекстом служит сводка сообщений из указанного диапазона.
+        """
+        chat_db_name = f"{username}_{flow_id}" if flow_id else f"{username}_main_chat"
+        chat_db = ChatDatabase(chat_db_name)
+
+        if relevant_k:
+            history = chat_db.search(message, relevant_k)
+        else:
+            # Читаем только сообщения из указанного диапазона
+            start_idx = max(0, context_range[0] - 1)
+            history = chat_db.range(start_idx, context_range[1])
+        
+        if not history:
+            return message
+        
+        try:
+            if relevant_k:
+                context_analysis = format_history(history)
+            else:
+                context_analysis = self.get_summary(chat_db_name, history, start_idx)
             
-            for attempt in range(max_retries):
-                try:
-                    response = requests.post(
-                        url="https://openrouter.ai/api/v1/chat/completions",
-                        headers={
-                            "Authorization": f"Bearer {self.openrouter_api_key}",
-                            "HTTP-Referer": "https://github.com/cursor-ai",
-                            "X-Title": "Cursor AI Assistant",
-                            "Content-Type": "application/json"
-                        },
-                        data=json.dumps({
-                            "model": "google/gemini-flash-1.5",
-                            "messages": [
-                                {
-                                    "role": "user",
-                                    "content": context_prompt
-                                }
-                            ],
-                            "max_tokens": 2048,
-                            "temperature": 0.2,
-                            "top_p": 0.9,
-                            "n": 1
-                        })
-                    )
-                    
-                    if response.status_code == 200:
-                        response_data = response.json()
-                        context_analysis = response_data['choices'][0]['message']['content'].strip()
-                        print(f"Получен анализ контекста для чата {chat_db_name}")
-                    else:
-                        print(f"Неожиданный формат ответа для чата {chat_db_name}")
-                        return message
-                    
-                    if not context_analysis:
-                        return message
-                    
-                    # Формируем финальное сообщение с контекстом
-                    enhanced_message = f"""Контекст текущего чата:
+            if not context_analysis:
+                return message
+            
+            # Формируем финальное сообщение с контекстом
+            enhanced_message = f"""Контекст текущего чата:
 {context_analysis}
 
 Текущий вопрос:
 {message}
 
 Используя контекст ТОЛЬКО ЭТОГО чата, дай подробный и связный ответ. Убедись, что ответ логически связан с предыдущими темами разговора В ЭТОМ ЧАТЕ."""
-                    
-                    return enhanced_message
-                    
-                except (ConnectionError, TimeoutError) as e:
-                    if attempt < max_retries - 1:
-                        print(f"Попытка {attempt + 1} не удалась для чата {chat_db_name}: {str(e)}")
-                        time.sleep(retry_delay)
-                        continue
-                    else:
-                        print(f"Все попытки исчерпаны для чата {chat_db_name}")
-                        return message
-                        
-                except Exception as e:
-                    print(f"Ошибка при анализе контекста для чата {chat_db_name}: {str(e)}")
-                    return message
+            
+            return enhanced_message
                     
         except Exception as e:
             print(f"Ошибка при обработке истории чата {chat_db_name}: {str(e)}")
-            return message
\ No newline at end of file
+            return message
@@ -0,0 +1,76 @@
+import math
+
+# Бюджет токенов на промпт по умолчанию: системное сообщение, история и текущий вопрос
+CONTEXT_TOKEN_BUDGET = 4000
+# Служебные токены на одно сообщение (роль, разделители)
+MESSAGE_TOKEN_OVERHEAD = 4
+# Сообщение, от которого в бюджет помещается меньше, обрезается целиком
+MIN_TRUNCATED_TOKENS = 64
+TRUNCATION_MARK = " […]"
+
+
+def estimate_tokens(text):
+    """
+    Оценка числа токенов без токенизатора: около 4 байт UTF-8 на токен.
+    Для латиницы это ~4 символа на токен, для кириллицы ~2, что близко к реальным токенизаторам.
+    """
+    if not text:
+        return MESSAGE_TOKEN_OVERHEAD
+    return MESSAGE_TOKEN_OVERHEAD + math.ceil(len(text.encode("utf-8")) / 4)
+
+
+def message_tokens(message):
+    """Токены сообщения: посчитанные при сохранении или оценка для старых записей"""
+    tokens = message.get("tokens")
+    if tokens is None:
+        tokens = estimate_tokens(message["content"])
+    return tokens
+
+
+def truncate_to_tokens(text, tokens):
+    """Обрезает текст примерно до tokens токенов, сохраняя его начало"""
+    available = tokens - estimate_tokens(TRUNCATION_MARK)
+    if available <= 0:
+        return ""
+    truncated = text.encode("utf-8")[:available * 4].decode("utf-8", errors="ignore")
+    return truncated.rstrip() + TRUNCATION_MARK
+
+
+def build_context(history, budget):
+    """
+    Отбирает из истории самые новые сообщения, помещающиеся в budget токенов.
+    Первое не поместившееся сообщение обрезается, если от бюджета осталось хотя бы
+    MIN_TRUNCATED_TOKENS, более ранние отбрасываются. Возвращает сообщения для API
+    в хронологическом порядке.
+    """
+    selected = []
+    for message in reversed(history):
+        tokens = message_tokens(message)
+        if tokens <= budget:
+            selected.append({"role": message["role"], "content": message["content"]})
+            budget -= tokens
+            continue
+        if budget >= MIN_TRUNCATED_TOKENS:
+            selected.append({"role": message["role"], "content": truncate_to_tokens(message["content"], budget)})
+        break
+    selected.reverse()
+    return selected
+
+
+def build_prompt(system_prompt, history, question, budget=CONTEXT_TOKEN_BUDGET, relevant=()):
+    """
+    Собирает сообщения для API: системное сообщение, историю в пределах бюджета и вопрос.
+    Системное сообщение и вопрос передаются всегда, история получает остаток бюджета.
+    relevant - более ранние сообщения чата, близкие к вопросу (ChatDatabase.search): они идут
+    перед историей и получают то, что от бюджета осталось после нее.
+    """
+    budget -= estimate_tokens(system_prompt) + estimate_tokens(question)
+    messages = [{"role": "system", "content": system_prompt}]
+    if budget > 0:
+        recent = build_context(history, budget)
+        budget -= sum(estimate_tokens(message["content"]) for message in recent)
+        if relevant and budget > 0:
+            messages.extend(build_context(relevant, budget))
+        messages.extend(recent)
+    messages.append({"role": "user", "content": question})
+    return messages
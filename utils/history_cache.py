@@ -0,0 +1,122 @@
+import os
+import threading
+from collections import OrderedDict
+
+# Предел памяти под разобранные истории чатов (байты, оценка по размеру текста)
+HISTORY_CACHE_MAX_BYTES = int(os.environ.get("HISTORY_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+# Истории больше этой доли предела не кэшируются и читаются из файла окнами
+HISTORY_CACHE_MAX_ENTRY_SHARE = 4
+# Накладные расходы Python на одно сообщение (словарь, строки, индекс позиций)
+MESSAGE_OVERHEAD = 400
+
+
+def estimate_message_size(message):
+    return MESSAGE_OVERHEAD + sum(len(str(value)) for value in message.values())
+
+
+class _CacheEntry:
+    __slots__ = ("snapshot", "signature", "size")
+
+    def __init__(self, snapshot, signature, size):
+        self.snapshot = snapshot
+        self.signature = signature
+        self.size = size
+
+
+class HistoryCache:
+    """
+    Общий для процесса LRU-кэш разобранных историй чатов.
+    Запись хранит подпись файла (время изменения, размер): если файл изменили в обход кэша,
+    запись считается устаревшей. ChatDatabase обновляет кэш при каждой своей записи.
+    """
+
+    def __init__(self, max_bytes=HISTORY_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def fits(self, size):
+        """Поместится ли история такого размера в кэш"""
+        return size <= self.max_bytes // HISTORY_CACHE_MAX_ENTRY_SHARE
+
+    def get(self, key, signature):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.signature != signature:
+                self.misses += 1
+                if entry is not None:
+                    self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.snapshot
+
+    def put(self, key, snapshot, signature):
+        size = sum(estimate_message_size(message) for message in snapshot)
+        with self._lock:
+            self._remove(key)
+            if not self.fits(size):
+                return
+            self._entries[key] = _CacheEntry(snapshot, signature, size)
+            self.size += size
+            self._evict()
+
+    def append(self, key, message, previous_signature, signature):
+        """
+        Дописывает сообщение в закэшированную историю (если она есть в кэше).
+        previous_signature - подпись файла перед записью: если она не совпадает с подписью записи,
+        файл меняли в обход кэша, и запись удаляется, а не дополняется.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            if entry.signature != previous_signature:
+                self._remove(key)
+                return
+            if not entry.snapshot.add(message):
+                # Сообщение попало в снимок при его загрузке из файла
+                entry.signature = signature
+                self._entries.move_to_end(key)
+                return
+            message_size = estimate_message_size(message)
+            entry.size += message_size
+            entry.signature = signature
+            self.size += message_size
+            self._entries.move_to_end(key)
+            if not self.fits(entry.size):
+                self._remove(key)
+            self._evict()
+
+    def invalidate(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "size": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def _evict(self):
+        while self.size > self.max_bytes and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            self.size -= entry.size
+            self.evictions += 1
+
+
+history_cache = HistoryCache()
@@ -0,0 +1,35 @@
+import streamlit as st
+
+# Сколько последних сообщений показывается сразу и сколько добавляет кнопка "Показать более ранние"
+HISTORY_PAGE_SIZE = 20
+
+
+def _show_older(state_key):
+    st.session_state[state_key] = st.session_state.get(state_key, HISTORY_PAGE_SIZE) + HISTORY_PAGE_SIZE
+
+
+def get_visible_history(chat_db, state_key):
+    """
+    Возвращает окно истории для отображения: последние сообщения чата
+    (по умолчанию HISTORY_PAGE_SIZE) и номер первого из них с единицы.
+    Более ранние сообщения догружаются кнопкой постранично; с диска читается только окно.
+    """
+    total = chat_db.count()
+    visible = st.session_state.get(state_key, HISTORY_PAGE_SIZE)
+    start = max(0, total - visible)
+
+    if start > 0:
+        st.button(
+            f"⬆️ Показать более ранние сообщения (скрыто: {start})",
+            key=f"{state_key}_older",
+            on_click=_show_older,
+            args=(state_key,),
+            use_container_width=True
+        )
+
+    return chat_db.range(start, total), start + 1
+
+
+def reset_visible_history(state_key):
+    """Возвращает окно истории к последним сообщениям (например, при смене или очистке чата)"""
+    st.session_state.pop(state_key, None)
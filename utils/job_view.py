@@ -0,0 +1,59 @@
+import time
+import streamlit as st
+from utils.llm_jobs import llm_jobs, JOB_ERROR, JOB_QUEUED
+from utils.llm_client import LLMAPIError
+from utils.timer import display_timer, stop_timer
+
+# Как часто страница перерисовывает ответ, который генерируется в фоне (секунды)
+JOB_POLL_INTERVAL = 0.3
+
+
+def _waiting_text(job):
+    """Состояние запроса, пока модель не начала отвечать"""
+    position = llm_jobs.position(job)
+    if position:
+        return f"⏳ Запрос в очереди, позиция: {position}"
+    if job.status == JOB_QUEUED:
+        return "⏳ Запрос в очереди..."
+    return "Ожидание ответа..."
+
+
+def show_pending_job(job_key, avatar):
+    """
+    Показывает ответ модели, который генерируется в фоне для этого чата, пока он не будет готов.
+    Если прогон прервется (пользователь нажал кнопку), запрос продолжит выполняться,
+    и следующий прогон снова покажет его здесь. По завершении ответ уже сохранен в истории,
+    поэтому страница перезапускается и показывает его вместе с остальными сообщениями.
+    """
+    job = llm_jobs.get(job_key)
+    if job is None:
+        return
+
+    if not job.finished:
+        progress_container = st.empty()
+        display_timer(progress_container, job.created_at)
+        with st.chat_message("assistant", avatar=avatar):
+            placeholder = st.empty()
+            shown = None
+            while not job.finished:
+                # Браузеру отправляется только изменившийся текст
+                text = (job.text or _waiting_text(job)) + " ▌"
+                if text != shown:
+                    placeholder.markdown(text)
+                    shown = text
+                # Обращение к session_state - точка, где Streamlit прерывает прогон по нажатию кнопки:
+                # без него страница не откликается, пока текст ответа не изменится
+                st.session_state.get("username")
+                time.sleep(JOB_POLL_INTERVAL)
+        stop_timer(progress_container)
+        llm_jobs.pop(job_key)
+        if job.status != JOB_ERROR:
+            st.rerun()
+    else:
+        llm_jobs.pop(job_key)
+
+    if job.status == JOB_ERROR:
+        if isinstance(job.error, LLMAPIError):
+            st.error(str(job.error))
+        else:
+            st.error(f"Ошибка при получении ответа: {str(job.error)}")
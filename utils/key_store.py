@@ -0,0 +1,96 @@
+import json
+import os
+from datetime import datetime
+from utils.sqlite_db import get_connection, transaction, table_exists
+
+
+class KeyStore:
+    """
+    Хранилище ключей доступа в SQLite.
+    Ключ - первичный ключ таблицы, поэтому проверка и погашение выполняются по индексу.
+    """
+
+    def __init__(self, db_path, legacy_paths=()):
+        self.db_path = db_path
+        self._init_schema(legacy_paths)
+
+    @property
+    def conn(self):
+        return get_connection(self.db_path)
+
+    def _init_schema(self, legacy_paths):
+        conn = self.conn
+        with transaction(conn):
+            if table_exists(conn, "access_keys"):
+                return
+            conn.execute("""
+                CREATE TABLE access_keys (
+                    token TEXT PRIMARY KEY,
+                    generations INTEGER NOT NULL,
+                    created_at TEXT NOT NULL
+                )
+            """)
+            for legacy_path in legacy_paths:
+                if os.path.exists(legacy_path):
+                    self._import_legacy(conn, legacy_path)
+
+    def _import_legacy(self, conn, legacy_path):
+        """Переносит ключи из access_keys.json"""
+        try:
+            with open(legacy_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception as e:
+            print(f"Ошибка чтения ключей {legacy_path}: {str(e)}")
+            return
+        generations = data.get("generations", {})
+        tokens = [token.strip('"') for token in data.get("keys", [])]
+        self._insert(conn, [(token, generations.get(token, 500)) for token in tokens])
+        print(f"Перенесено ключей из {legacy_path}: {len(tokens)}")
+
+    @staticmethod
+    def _insert(conn, items):
+        created_at = datetime.now().isoformat()
+        conn.executemany(
+            "INSERT OR REPLACE INTO access_keys (token, generations, created_at) VALUES (?, ?, ?)",
+            [(token, generations, created_at) for token, generations in items]
+        )
+
+    def add(self, token, generations=500):
+        self.add_many([token], generations)
+
+    def add_many(self, tokens, generations=500):
+        """Добавляет пачку ключей одной транзакцией"""
+        with transaction(self.conn) as conn:
+            self._insert(conn, [(token.strip('"'), generations) for token in tokens])
+
+    def get_generations(self, token):
+        """Количество генераций ключа или None, если ключа нет"""
+        row = self.conn.execute("SELECT generations FROM access_keys WHERE token = ?", (token,)).fetchone()
+        return row["generations"] if row else None
+
+    def __contains__(self, token):
+        return self.get_generations(token) is not None
+
+    def keys(self):
+        return [row["token"] for row in self.conn.execute("SELECT token FROM access_keys ORDER BY rowid")]
+
+    def consume(self, token, conn=None):
+        """
+        Погашает ключ: удаляет его и возвращает количество генераций (или None, если ключа нет).
+        Если передано соединение conn, операция выполняется внутри уже открытой транзакции.
+        """
+        if conn is None:
+            with transaction(self.conn) as conn:
+                return self.consume(token, conn)
+        row = conn.execute("SELECT generations FROM access_keys WHERE token = ?", (token,)).fetchone()
+        if not row:
+            return None
+        conn.execute("DELETE FROM access_keys WHERE token = ?", (token,))
+        return row["generations"]
+
+    def remove(self, token, conn=None):
+        if conn is None:
+            with transaction(self.conn) as conn:
+                return self.remove(token, conn)
+        cursor = conn.execute("DELETE FROM access_keys WHERE token = ?", (token.strip('"'),))
+        return cursor.rowcount > 0
@@ -0,0 +1,107 @@
+import re
+
+# Доля букв одной письменности, при которой язык определяется без n-грамм.
+# Смешанные тексты (русский с терминами и именами функций, английский с русскими цитатами)
+# определяются по триграммам
+SCRIPT_THRESHOLD = 0.8
+
+# Частые триграммы (пробел - граница слова), от самых частых к менее частым
+EN_TRIGRAMS = [
+    " th", "the", "he ", "ing", "nd ", " an", "and", "ng ", " of", "of ",
+    " to", "to ", "ed ", " in", "in ", "er ", "ion", "tio", "is ", "es ",
+    "on ", "ent", "re ", "at ", "ati", " co", "for", "or ", "ly ", " be",
+    " is", "ter", "her", "hat", "tha", " wh", "al ", "st ", "ere", "ve ",
+    "his", " re", "ers", " it", "it ", "nt ", "as ", "ith", "wit", " wi",
+    " fo", " ha", "ou ", " yo", "you", "are", " ar", "ll ", "le ", "ce ",
+]
+
+RU_TRIGRAMS = [
+    " по", "ть ", "ого", "ени", " на", "ова", " пр", "ост", "ния", "ия ",
+    " ко", "ста", "не ", "ли ", "ать", " не", "ет ", "ся ", " в ", "го ",
+    "ие ", "ой ", "ые ", "сто", "ра ", "про", "то ", "ани", " за", " с ",
+    " и ", "ель", "его", "ных", "ный", "при", "ает", " ра", " до", " об",
+    "тор", "ите", "ом ", "ем ", " от", "ую ", " ка", "как", "ак ", " мо",
+    "что", " чт", "это", " эт", "ции", "ват", "ен ", "ых ", "для", " дл",
+]
+
+# Служебные слова: их дает сам язык текста, а не вставленные в него термины и имена функций,
+# поэтому каждое такое слово весит как несколько частых триграмм
+FUNCTION_WORD_WEIGHT = 2.0
+FUNCTION_WORDS = {
+    "en": {
+        "the", "a", "an", "and", "or", "of", "to", "in", "on", "for", "with", "from", "by", "at",
+        "is", "are", "was", "be", "it", "this", "that", "you", "we", "not", "if", "then", "as",
+    },
+    "ru": {
+        "и", "а", "но", "или", "в", "во", "на", "с", "со", "к", "по", "из", "за", "для", "от", "до",
+        "не", "что", "это", "как", "если", "то", "вы", "мы", "он", "она", "они", "его", "их", "же",
+    },
+}
+
+_NON_LETTERS = re.compile(r"[^\w]+|[\d_]+")
+# Блоки кода, встроенный код и ссылки не говорят о языке текста
+_CODE_AND_URLS = re.compile(r"```.*?(?:```|$)|`[^`\n]*`|https?://\S+|www\.\S+", re.DOTALL)
+
+
+def _build_profile(trigrams):
+    """Вес триграммы убывает с ее рангом в списке"""
+    profile = {}
+    for rank, trigram in enumerate(trigrams):
+        profile.setdefault(trigram, (len(trigrams) - rank) / len(trigrams))
+    return profile
+
+
+PROFILES = {
+    "en": _build_profile(EN_TRIGRAMS),
+    "ru": _build_profile(RU_TRIGRAMS),
+}
+
+
+def _trigrams(text):
+    normalized = " " + " ".join(_NON_LETTERS.sub(" ", text.lower()).split()) + " "
+    return [normalized[i:i + 3] for i in range(len(normalized) - 2)]
+
+
+def _script_counts(text):
+    cyrillic = latin = 0
+    for char in text:
+        if "Ѐ" <= char <= "ӿ":
+            cyrillic += 1
+        elif "a" <= char.lower() <= "z":
+            latin += 1
+    return cyrillic, latin
+
+
+def detect_language(text, default="en"):
+    """
+    Определяет язык текста (ru или en) локально, без обращения к сервисам.
+    Код и ссылки не учитываются. Текст почти целиком на одной письменности определяется по ней;
+    для смешанных текстов сравнивается частота характерных триграмм и служебных слов.
+    """
+    if not text or not isinstance(text, str):
+        return default
+
+    prose = _CODE_AND_URLS.sub(" ", text)
+    # Текст целиком из кода - определяем по нему
+    if prose.strip():
+        text = prose
+
+    cyrillic, latin = _script_counts(text)
+    letters = cyrillic + latin
+    if not letters:
+        return default
+    if cyrillic >= letters * SCRIPT_THRESHOLD:
+        return "ru"
+    if latin >= letters * SCRIPT_THRESHOLD:
+        return "en"
+
+    trigrams = _trigrams(text)
+    words = _NON_LETTERS.sub(" ", text.lower()).split()
+    scores = {
+        lang: sum(profile.get(trigram, 0) for trigram in trigrams)
+        + FUNCTION_WORD_WEIGHT * sum(word in FUNCTION_WORDS[lang] for word in words)
+        for lang, profile in PROFILES.items()
+    }
+    if scores["ru"] == scores["en"]:
+        return "ru" if cyrillic * 2 >= letters else "en"
+    return max(scores, key=scores.get)
@@ -0,0 +1,175 @@
+import json
+from contextlib import contextmanager
+import requests
+from requests.adapters import HTTPAdapter
+import streamlit as st
+from utils.llm_scheduler import llm_scheduler, QueueTimeoutError
+
+OPENROUTER_API_URL = "https://openrouter.ai/api/v1/chat/completions"
+
+DEFAULT_MODEL = "google/gemini-flash-1.5"
+
+# Таймауты (подключение, чтение) для всех запросов к OpenRouter
+DEFAULT_TIMEOUT = (10, 100)
+
+# Параметры генерации по умолчанию для моделей; явно переданные параметры имеют приоритет
+MODEL_DEFAULTS = {
+    "google/gemini-flash-1.5": {"max_tokens": 2048, "temperature": 0.7, "top_p": 0.9},
+    "google/gemini-flash-1.5-exp": {"max_tokens": 2048, "temperature": 0.7, "top_p": 0.9},
+    "mistralai/ministral-8b": {"max_tokens": 2048, "temperature": 0.7, "top_p": 0.9},
+}
+
+# Размер пула соединений: сессии Streamlit выполняются в разных потоках одного процесса
+POOL_MAXSIZE = 32
+
+
+class LLMAPIError(Exception):
+    """Ошибка, которую вернул OpenRouter"""
+
+    def __init__(self, status_code, message):
+        super().__init__(f"Ошибка API (код {status_code}): {message}")
+        self.status_code = status_code
+        self.message = message
+
+
+def get_headers():
+    return {
+        "Authorization": f"Bearer {st.secrets['openrouter']['api_key']}",
+        "HTTP-Referer": "https://github.com/cursor-ai",
+        "X-Title": "Cursor AI Assistant",
+        "Content-Type": "application/json"
+    }
+
+
+def _create_session():
+    """Общая для процесса сессия: соединения с OpenRouter переиспользуются (keep-alive)"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def _create_http2_client():
+    """
+    Клиент HTTP/2 (httpx), если он включен в secrets (openrouter.http2 = true)
+    и установлены httpx и h2. Иначе используется пул requests.
+    """
+    try:
+        if not st.secrets["openrouter"].get("http2", False):
+            return None
+        import httpx
+        import h2  # noqa: F401
+    except Exception:
+        return None
+    limits = httpx.Limits(max_connections=POOL_MAXSIZE, max_keepalive_connections=POOL_MAXSIZE)
+    return httpx.Client(http2=True, limits=limits)
+
+
+_session = _create_session()
+_http2_client = _create_http2_client()
+
+
+class _Response:
+    def __init__(self, status_code, read_text, iter_lines):
+        self.status_code = status_code
+        self.read_text = read_text
+        self.iter_lines = iter_lines
+
+
+@contextmanager
+def _post(payload, timeout, stream=False):
+    """Отправляет запрос через HTTP/2-клиент или пул requests"""
+    timeout = timeout or DEFAULT_TIMEOUT
+    if _http2_client is not None:
+        import httpx
+        connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        try:
+            with _http2_client.stream(
+                "POST", OPENROUTER_API_URL, headers=get_headers(), json=payload,
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout)
+            ) as response:
+                yield _Response(
+                    response.status_code,
+                    lambda: response.read().decode("utf-8", errors="replace"),
+                    lambda: (line.encode("utf-8") for line in response.iter_lines())
+                )
+        except httpx.HTTPError as e:
+            # Страницы обрабатывают сетевые ошибки как исключения requests
+            raise requests.exceptions.ConnectionError(str(e)) from e
+        return
+
+    response = _session.post(OPENROUTER_API_URL, headers=get_headers(), json=payload, stream=stream, timeout=timeout)
+    try:
+        yield _Response(
+            response.status_code,
+            lambda: response.content.decode("utf-8", errors="replace"),
+            response.iter_lines
+        )
+    finally:
+        response.close()
+
+
+@contextmanager
+def _scheduled(user_key, on_queue):
+    """Место в общем планировщике запросов; не дождавшийся очереди запрос получает ошибку 429"""
+    try:
+        with llm_scheduler.slot(user_key, on_wait=on_queue):
+            yield
+    except QueueTimeoutError:
+        raise LLMAPIError(429, "Сервис перегружен, попробуйте повторить запрос позже")
+
+
+def _build_payload(messages, model, params):
+    model = model or DEFAULT_MODEL
+    payload = dict(MODEL_DEFAULTS.get(model, {}))
+    payload.update(params)
+    payload.update(model=model, messages=messages)
+    return payload
+
+
+def chat_completion(messages, model=None, timeout=None, user_key=None, on_queue=None, **params):
+    """
+    Обычный (не потоковый) запрос; возвращает текст ответа.
+    user_key - пользователь для планировщика (None - служебный запрос), on_queue(position) -
+    уведомление о позиции в очереди, пока запрос ждет свободного места.
+    """
+    payload = _build_payload(messages, model, params)
+    with _scheduled(user_key, on_queue), _post(payload, timeout) as response:
+        if response.status_code != 200:
+            raise LLMAPIError(response.status_code, response.read_text())
+        try:
+            data = json.loads(response.read_text())
+            return data['choices'][0]['message']['content']
+        except (ValueError, KeyError, IndexError):
+            raise LLMAPIError(response.status_code, "Неожиданный формат ответа")
+
+
+def stream_chat_completion(messages, model=None, timeout=None, user_key=None, on_queue=None, **params):
+    """
+    Отправляет запрос в режиме stream и по мере поступления отдает фрагменты ответа.
+    Подходит для st.write_stream: страница показывает текст сразу, не дожидаясь конца генерации.
+    Место в планировщике удерживается, пока не прочитан весь ответ (user_key и on_queue - как в chat_completion).
+    """
+    payload = _build_payload(messages, model, params)
+    payload["stream"] = True
+    with _scheduled(user_key, on_queue), _post(payload, timeout, stream=True) as response:
+        if response.status_code != 200:
+            raise LLMAPIError(response.status_code, response.read_text())
+
+        for raw_line in response.iter_lines():
+            # Поток - это Server-Sent Events: строки "data: {...}" и служебные комментарии ": ..."
+            line = raw_line.decode("utf-8").strip()
+            if not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            chunk = json.loads(data)
+            if "error" in chunk:
+                error = chunk["error"]
+                raise LLMAPIError(error.get("code", response.status_code), error.get("message", "Unknown error"))
+            choices = chunk.get("choices") or [{}]
+            delta = choices[0].get("delta", {}).get("content")
+            if delta:
+                yield delta
@@ -0,0 +1,219 @@
+import os
+import threading
+import time
+from collections import deque
+from utils.chat_database import ChatDatabase
+from utils.llm_client import stream_chat_completion, LLMAPIError
+from utils.llm_scheduler import llm_scheduler, round_robin_position, QUEUE_POLL_INTERVAL
+
+# Количество потоков, выполняющих запросы к модели (переменная окружения LLM_WORKERS)
+LLM_WORKERS = int(os.environ.get("LLM_WORKERS", 4))
+# Сколько задач одного пользователя выполняется одновременно; остальные ждут, не занимая потоки
+JOB_USER_CONCURRENCY = 2
+# Сколько секунд хранится результат задачи, которую страница так и не забрала
+JOB_RESULT_TTL = 60 * 60
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_ERROR = "error"
+
+
+class LLMJob:
+    """
+    Запрос к модели, выполняемый в фоне. Пока задача выполняется, в text накапливается
+    полученная часть ответа; после завершения ответ уже сохранен в истории чата.
+    """
+
+    def __init__(self, key, chat_id, messages, model, params, on_done=None, on_error=None):
+        self.key = key
+        self.chat_id = chat_id
+        self.messages = messages
+        self.model = model
+        self.params = params
+        self.on_done = on_done
+        self.on_error = on_error
+        self.status = JOB_QUEUED
+        # Позиция в очереди планировщика запросов, пока запущенный запрос ждет свободного места
+        self.queue_position = None
+        self.text = ""
+        self.error = None
+        self.message_id = None
+        self.created_at = time.time()
+        self.finished_at = None
+
+    @property
+    def user_key(self):
+        return self.key[0]
+
+    @property
+    def finished(self):
+        return self.status in (JOB_DONE, JOB_ERROR)
+
+
+class LLMJobQueue:
+    """
+    Общая для процесса очередь запросов к модели с пулом потоков.
+    Задача живет независимо от прогона скрипта Streamlit: перезапуск страницы
+    (любое нажатие кнопки) не прерывает запрос, а ответ записывается в ChatDatabase.
+    Ключ задачи - пара (пользователь, чат); на один ключ выполняется не больше одной задачи,
+    поэтому вкладки одного пользователя с одним чатом делят ее.
+    Ожидающие задачи раздаются потокам по кругу между пользователями, и у одного пользователя
+    выполняется не больше JOB_USER_CONCURRENCY задач: его запросы не занимают все потоки.
+    Задача получает поток, только когда планировщик запросов готов ее пропустить (llm_scheduler.ready):
+    задачи, ждущие корзину пользователя или общий лимит, ждут в этой очереди, а не в потоках.
+    """
+
+    def __init__(self, workers=LLM_WORKERS):
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._has_work = threading.Condition(self._lock)
+        self._pending = {}     # пользователь -> очередь его задач
+        self._order = deque()  # пользователи с ожидающими задачами в порядке обслуживания
+        self._running = {}     # пользователь -> сколько его задач выполняется
+        self._threads = []
+        self.set_workers(workers)
+
+    def set_workers(self, workers):
+        """Увеличивает число рабочих потоков до workers (уменьшение вступает в силу после перезапуска)"""
+        with self._lock:
+            self.workers = max(workers, 1)
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run, name=f"llm-worker-{len(self._threads)}", daemon=True)
+                self._threads.append(thread)
+                thread.start()
+
+    def submit(self, key, chat_id, messages, model=None, on_done=None, on_error=None, **params):
+        """
+        Ставит запрос в очередь и возвращает (задача, создана ли она). Если по ключу уже выполняется
+        задача, возвращается она, а новая не создается (повторная отправка, вторая вкладка):
+        в этом случае on_done и on_error не будут вызваны, и ресурсы, выделенные под запрос
+        (резерв генерации), освобождает вызывающий код.
+        on_done(text) и on_error(error) вызываются в рабочем потоке: в них нельзя обращаться к st.
+        """
+        with self._lock:
+            self._drop_expired()
+            job = self._jobs.get(key)
+            if job is not None and not job.finished:
+                return job, False
+            job = self._jobs[key] = LLMJob(key, chat_id, messages, model, params, on_done, on_error)
+            if job.user_key not in self._pending:
+                self._pending[job.user_key] = deque()
+                self._order.append(job.user_key)
+            self._pending[job.user_key].append(job)
+            self._has_work.notify()
+        return job, True
+
+    def get(self, key):
+        with self._lock:
+            return self._jobs.get(key)
+
+    def pop(self, key):
+        """Забирает завершенную задачу (страница показала ее результат)"""
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and job.finished:
+                return self._jobs.pop(key)
+            return None
+
+    def position(self, job):
+        """
+        Позиция задачи в очереди (с единицы) или None, если задача не ждет.
+        Для задачи, ждущей поток, учитываются и запросы, уже ждущие в планировщике.
+        """
+        with self._lock:
+            queue = self._pending.get(job.user_key)
+            if job.status != JOB_QUEUED or queue is None or job not in queue:
+                return job.queue_position
+            position = round_robin_position(self._pending, self._order, job.user_key, queue.index(job))
+        return position + llm_scheduler.stats()["waiting"]
+
+    def stats(self):
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+        return {
+            "workers": self.workers,
+            "queued": statuses.count(JOB_QUEUED),
+            "running": statuses.count(JOB_RUNNING),
+            "finished": statuses.count(JOB_DONE) + statuses.count(JOB_ERROR),
+        }
+
+    def _drop_expired(self):
+        now = time.time()
+        expired = [key for key, job in self._jobs.items()
+                   if job.finished and now - job.finished_at > JOB_RESULT_TTL]
+        for key in expired:
+            del self._jobs[key]
+
+    def _next_job(self):
+        """Следующая задача по кругу между пользователями (ждет, пока такая появится)"""
+        with self._has_work:
+            while True:
+                for _ in range(len(self._order)):
+                    user_key = self._order[0]
+                    self._order.rotate(-1)
+                    if self._running.get(user_key, 0) >= JOB_USER_CONCURRENCY:
+                        continue
+                    if not llm_scheduler.ready(user_key):
+                        continue
+                    queue = self._pending[user_key]
+                    job = queue.popleft()
+                    if not queue:
+                        del self._pending[user_key]
+                        self._order.remove(user_key)
+                    self._running[user_key] = self._running.get(user_key, 0) + 1
+                    job.status = JOB_RUNNING
+                    return job
+                # Корзины пополняются и места в планировщике освобождаются без сигналов этой очереди,
+                # поэтому при ожидающих задачах очередь перепроверяется периодически
+                self._has_work.wait(QUEUE_POLL_INTERVAL if self._order else None)
+
+    def _job_finished(self, job):
+        with self._has_work:
+            self._running[job.user_key] -= 1
+            if not self._running[job.user_key]:
+                del self._running[job.user_key]
+            self._has_work.notify_all()
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            try:
+                self._execute(job)
+            finally:
+                self._job_finished(job)
+
+    def _execute(self, job):
+        try:
+            chunks = stream_chat_completion(
+                job.messages,
+                model=job.model,
+                user_key=job.user_key,
+                on_queue=lambda position: setattr(job, "queue_position", position),
+                **job.params
+            )
+            for chunk in chunks:
+                job.text += chunk
+            if not job.text:
+                raise LLMAPIError(200, "Получен пустой ответ")
+            job.message_id = ChatDatabase(job.chat_id).add_message("assistant", job.text)
+        except Exception as e:
+            print(f"Ошибка фонового запроса к модели ({job.chat_id}): {str(e)}")
+            job.error = e
+            self._finish(job, JOB_ERROR, job.on_error, e)
+        else:
+            self._finish(job, JOB_DONE, job.on_done, job.text)
+
+    @staticmethod
+    def _finish(job, status, callback, argument):
+        try:
+            if callback is not None:
+                callback(argument)
+        except Exception as e:
+            print(f"Ошибка обработчика завершения запроса ({job.chat_id}): {str(e)}")
+        finally:
+            job.finished_at = time.time()
+            job.status = status
+
+
+llm_jobs = LLMJobQueue()
@@ -0,0 +1,219 @@
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Сколько запросов к OpenRouter выполняется одновременно во всем процессе
+LLM_MAX_IN_FLIGHT = int(os.environ.get("LLM_MAX_IN_FLIGHT", 8))
+# Корзина токенов пользователя: сколько запросов можно начать подряд и скорость пополнения (в секунду)
+USER_BUCKET_CAPACITY = float(os.environ.get("LLM_USER_BURST", 3))
+USER_BUCKET_RATE = float(os.environ.get("LLM_USER_RATE", 0.2))
+# Сколько секунд запрос может ждать в очереди, прежде чем получит отказ
+LLM_QUEUE_TIMEOUT = float(os.environ.get("LLM_QUEUE_TIMEOUT", 180))
+# Как часто ожидающий запрос перепроверяет очередь и корзины (секунды)
+QUEUE_POLL_INTERVAL = 0.5
+
+
+class QueueTimeoutError(Exception):
+    """Запрос не дождался своей очереди"""
+
+
+class TokenBucket:
+    """Корзина токенов: capacity запросов подряд, затем rate запросов в секунду"""
+
+    def __init__(self, capacity=USER_BUCKET_CAPACITY, rate=USER_BUCKET_RATE):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def available(self):
+        """Сколько токенов в корзине сейчас (без списания)"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        return self.tokens
+
+    def take(self):
+        if self.available() < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+def round_robin_position(queues, order, user_key, index):
+    """
+    Номер элемента (с единицы) при обслуживании очередей пользователей по кругу:
+    queues - пользователь -> его очередь, order - пользователи в порядке обслуживания,
+    index - место элемента в очереди user_key. Корзины токенов не учитываются.
+    """
+    turn = order.index(user_key)
+    ahead = index
+    for i, other in enumerate(order):
+        if other == user_key:
+            continue
+        size = len(queues[other])
+        ahead += min(size, index) + (1 if i < turn and size > index else 0)
+    return ahead + 1
+
+
+class _Ticket:
+    __slots__ = ("user_key", "granted")
+
+    def __init__(self, user_key):
+        self.user_key = user_key
+        self.granted = False
+
+
+class LLMScheduler:
+    """
+    Планировщик запросов к модели: не больше max_in_flight одновременных запросов на процесс
+    и корзина токенов на каждого пользователя. Ожидающие запросы обслуживаются по кругу
+    между пользователями (у каждого своя очередь), поэтому пользователь с множеством вкладок
+    не задерживает остальных. Запросы без пользователя (служебные) ограничены только общим лимитом.
+    """
+
+    def __init__(self, max_in_flight=LLM_MAX_IN_FLIGHT, bucket_capacity=USER_BUCKET_CAPACITY,
+                 bucket_rate=USER_BUCKET_RATE):
+        self.max_in_flight = max_in_flight
+        self.bucket_capacity = bucket_capacity
+        self.bucket_rate = bucket_rate
+        self.in_flight = 0
+        self._cond = threading.Condition()
+        self._queues = {}     # пользователь -> очередь его ожидающих запросов
+        self._order = deque()  # пользователи с ожидающими запросами в порядке обслуживания
+        self._buckets = {}
+
+    @contextmanager
+    def slot(self, user_key=None, on_wait=None, timeout=LLM_QUEUE_TIMEOUT):
+        """
+        Ждет своей очереди и удерживает место на время запроса.
+        on_wait(position) вызывается в ожидающем потоке при изменении позиции в очереди (с единицы)
+        и on_wait(None), когда после ожидания место получено.
+        Если место не освободилось за timeout секунд, выбрасывает QueueTimeoutError.
+        """
+        ticket = self._enqueue(user_key)
+        try:
+            self._wait(ticket, on_wait, timeout)
+        except BaseException:
+            self._cancel(ticket)
+            raise
+        try:
+            yield
+        finally:
+            self._release()
+
+    def ready(self, user_key=None):
+        """
+        Получит ли запрос пользователя место сразу, без ожидания в очереди (ничего не занимает).
+        Очередь задач проверяет это, прежде чем отдать задачу потоку: запрос, которому пришлось бы
+        ждать свою корзину или общий лимит, не держит рабочий поток.
+        """
+        with self._cond:
+            waiting = sum(len(queue) for queue in self._queues.values())
+            if self.in_flight + waiting >= self.max_in_flight:
+                return False
+            if user_key is None:
+                return True
+            bucket = self._buckets.get(user_key)
+            if bucket is None:
+                return True
+            return bucket.available() >= 1 + len(self._queues.get(user_key, ()))
+
+    def stats(self):
+        with self._cond:
+            return {
+                "in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+                "waiting": sum(len(queue) for queue in self._queues.values()),
+                "waiting_users": len(self._order),
+            }
+
+    def _enqueue(self, user_key):
+        ticket = _Ticket(user_key)
+        with self._cond:
+            if user_key not in self._queues:
+                self._queues[user_key] = deque()
+                self._order.append(user_key)
+            self._queues[user_key].append(ticket)
+            self._dispatch()
+        return ticket
+
+    def _wait(self, ticket, on_wait, timeout):
+        deadline = time.monotonic() + timeout
+        last_position = None
+        while True:
+            with self._cond:
+                if not ticket.granted:
+                    self._cond.wait(QUEUE_POLL_INTERVAL)
+                    # Корзины пополняются со временем, поэтому очередь перепроверяется и без сигналов
+                    self._dispatch()
+                if ticket.granted:
+                    break
+                position = self._position(ticket)
+            if time.monotonic() > deadline:
+                raise QueueTimeoutError("Превышено время ожидания в очереди запросов")
+            if on_wait is not None and position != last_position:
+                last_position = position
+                on_wait(position)
+        if on_wait is not None and last_position is not None:
+            on_wait(None)
+
+    def _cancel(self, ticket):
+        with self._cond:
+            if ticket.granted:
+                self.in_flight -= 1
+            else:
+                self._remove(ticket)
+            self._dispatch()
+
+    def _release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._dispatch()
+
+    def _bucket_allows(self, user_key):
+        if user_key is None:
+            return True
+        bucket = self._buckets.get(user_key)
+        if bucket is None:
+            bucket = self._buckets[user_key] = TokenBucket(self.bucket_capacity, self.bucket_rate)
+        return bucket.take()
+
+    def _dispatch(self):
+        """Выдает свободные места ожидающим запросам по кругу между пользователями (под self._cond)"""
+        granted = False
+        while self.in_flight < self.max_in_flight and self._order:
+            for _ in range(len(self._order)):
+                user_key = self._order[0]
+                self._order.rotate(-1)
+                if self._bucket_allows(user_key):
+                    break
+            else:
+                # Ни у кого из ожидающих нет токенов: ждем пополнения корзин
+                break
+            ticket = self._queues[user_key][0]
+            self._remove(ticket)
+            ticket.granted = True
+            self.in_flight += 1
+            granted = True
+        if granted:
+            self._cond.notify_all()
+
+    def _remove(self, ticket):
+        queue = self._queues.get(ticket.user_key)
+        if queue is None or ticket not in queue:
+            return
+        queue.remove(ticket)
+        if not queue:
+            del self._queues[ticket.user_key]
+            self._order.remove(ticket.user_key)
+
+    def _position(self, ticket):
+        """Номер запроса в очереди при обслуживании по кругу (без учета корзин)"""
+        index = self._queues[ticket.user_key].index(ticket)
+        return round_robin_position(self._queues, self._order, ticket.user_key, index)
+
+
+llm_scheduler = LLMScheduler()
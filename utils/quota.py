@@ -0,0 +1,172 @@
+import atexit
+import threading
+import time
+from utils.sqlite_db import transaction
+
+# Несохраненные списания сбрасываются в базу не реже, чем раз в QUOTA_FLUSH_INTERVAL секунд,
+# и сразу, если у пользователя их накопилось QUOTA_FLUSH_BATCH. Это и есть предел потерь при сбое.
+QUOTA_FLUSH_INTERVAL = 5.0
+QUOTA_FLUSH_BATCH = 10
+# Через сколько секунд счетчик без несохраненных списаний перечитывается из базы
+QUOTA_REFRESH_INTERVAL = 60.0
+
+
+class Reservation:
+    """Генерация, зарезервированная перед запросом к модели"""
+
+    def __init__(self, username, amount=1):
+        self.username = username
+        self.amount = amount
+        self.done = False
+
+
+class _Account:
+    __slots__ = ("remaining", "reserved", "pending", "loaded_at")
+
+    def __init__(self, remaining):
+        self.remaining = remaining  # остаток с учетом несохраненных списаний
+        self.reserved = 0           # зарезервировано запросами, которые еще выполняются
+        self.pending = 0            # списано, но еще не записано в базу
+        self.loaded_at = time.monotonic()
+
+
+class QuotaManager:
+    """
+    Счетчик генераций пользователей в памяти процесса.
+    Перед запросом к модели генерация резервируется (reserve), после ответа списывается (commit)
+    или возвращается (release). Списания записываются в базу пачками фоновым потоком.
+    """
+
+    def __init__(self, user_store, key_store, flush_interval=QUOTA_FLUSH_INTERVAL, flush_batch=QUOTA_FLUSH_BATCH):
+        self.user_store = user_store
+        self.key_store = key_store
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self._accounts = {}
+        self._lock = threading.Lock()
+        # Сброс в базу выполняется одним потоком за раз, иначе пачку можно вычесть дважды
+        self._flush_lock = threading.Lock()
+        self._flusher = threading.Thread(target=self._flush_loop, name="quota-flusher", daemon=True)
+        self._flusher.start()
+        atexit.register(self.flush)
+
+    @staticmethod
+    def _stored_remaining(user):
+        if not user or not user.get('active_token'):
+            return 0
+        return user.get('remaining_generations', 0)
+
+    def _account(self, username):
+        """Счетчик пользователя (вызывается под self._lock)"""
+        account = self._accounts.get(username)
+        if account is None:
+            account = self._accounts[username] = _Account(self._stored_remaining(self.user_store.get(username)))
+        elif not account.pending and not account.reserved and \
+                time.monotonic() - account.loaded_at >= QUOTA_REFRESH_INTERVAL:
+            self._refresh(account, username)
+        return account
+
+    def _refresh(self, account, username):
+        """Перечитывает остаток из базы, сохраняя несохраненные списания"""
+        account.remaining = self._stored_remaining(self.user_store.get(username)) - account.pending
+        account.loaded_at = time.monotonic()
+
+    def remaining(self, username):
+        """Сколько генераций осталось у пользователя (без учета резервов)"""
+        with self._lock:
+            return self._account(username).remaining
+
+    def reserve(self, username, amount=1):
+        """Резервирует генерации; возвращает Reservation или None, если их не хватает"""
+        with self._lock:
+            account = self._account(username)
+            if account.remaining - account.reserved < amount:
+                return None
+            account.reserved += amount
+            return Reservation(username, amount)
+
+    def commit(self, reservation):
+        """Списывает зарезервированные генерации"""
+        with self._lock:
+            if reservation.done:
+                return
+            reservation.done = True
+            account = self._account(reservation.username)
+            account.reserved -= reservation.amount
+            account.remaining -= reservation.amount
+            account.pending += reservation.amount
+            # Последнюю генерацию и полную пачку записываем сразу
+            flush_now = account.remaining <= 0 or account.pending >= self.flush_batch
+        if flush_now:
+            self.flush(reservation.username)
+
+    def release(self, reservation):
+        """Возвращает неиспользованный резерв (ошибка запроса, пустой ответ)"""
+        with self._lock:
+            if reservation.done:
+                return
+            reservation.done = True
+            self._account(reservation.username).reserved -= reservation.amount
+
+    def spend(self, username, amount=1):
+        """Списание без предварительного резерва"""
+        reservation = Reservation(username, amount)
+        with self._lock:
+            self._account(username).reserved += amount
+        self.commit(reservation)
+
+    def reload(self, username):
+        """Перечитывает остаток из базы (после активации ключа или ручного изменения)"""
+        self.flush(username)
+        with self._lock:
+            account = self._accounts.get(username)
+            if account is not None:
+                self._refresh(account, username)
+
+    def flush(self, username=None):
+        """Записывает несохраненные списания в базу"""
+        with self._flush_lock:
+            with self._lock:
+                names = [username] if username is not None else list(self._accounts)
+                batch = {name: self._accounts[name].pending for name in names
+                         if name in self._accounts and self._accounts[name].pending}
+            for name, spent in batch.items():
+                try:
+                    remaining = self._persist(name, spent)
+                except Exception as e:
+                    print(f"Ошибка сохранения генераций пользователя {name}: {str(e)}")
+                    continue
+                with self._lock:
+                    account = self._accounts[name]
+                    account.pending -= spent
+                    # Остаток в базе мог измениться в обход счетчика (например, в другом процессе)
+                    account.remaining = remaining - account.pending
+                    account.loaded_at = time.monotonic()
+
+    def _persist(self, username, spent):
+        """Вычитает spent из остатка в базе одной транзакцией; возвращает новый остаток"""
+        with transaction(self.user_store.conn) as conn:
+            user = self.user_store.get(username)
+            if not user:
+                return 0
+            remaining = self._stored_remaining(user) - spent
+            if remaining <= 0:
+                # Генерации закончились: деактивируем токен
+                if user.get('active_token'):
+                    self.key_store.remove(user['active_token'], conn=conn)
+                self.user_store.update(username, {
+                    'active_token': None,
+                    'remaining_generations': 0,
+                    'token_generations': 0
+                }, conn=conn)
+                return 0
+            self.user_store.update(username, {
+                'remaining_generations': remaining,
+                'token_generations': remaining
+            }, conn=conn)
+            return remaining
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
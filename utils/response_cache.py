@@ -0,0 +1,127 @@
+import hashlib
+import json
+import re
+import time
+from utils.sqlite_db import get_connection, transaction
+
+# Сколько секунд ответ считается актуальным
+RESPONSE_CACHE_TTL = 24 * 60 * 60
+# Сколько ответов хранится; при превышении удаляются давно не использованные
+RESPONSE_CACHE_MAX_ENTRIES = 2000
+# Порог сходства наборов слов (коэффициент Жаккара) для почти совпадающих вопросов
+NEAR_DUPLICATE_THRESHOLD = 0.85
+# Короткие вопросы сравниваются только точно: одно слово меняет их смысл
+NEAR_DUPLICATE_MIN_WORDS = 4
+# Слова, меняющие смысл вопроса на противоположный: вопросы, которые отличаются ими,
+# почти совпадающими не считаются ("t" - остаток английских don't, isn't, can't)
+NEGATION_WORDS = frozenset({
+    "не", "нет", "ни", "без", "нельзя", "никогда", "ничего",
+    "not", "no", "never", "without", "nor", "cannot", "t",
+})
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def normalize_question(question):
+    """Приводит вопрос к каноническому виду: регистр, ё, пробелы и знаки препинания не важны"""
+    return " ".join(_WORD_RE.findall(question.lower().replace("ё", "е")))
+
+
+class ResponseCache:
+    """
+    Постоянный кэш ответов модели в SQLite для одноразовых вопросов без истории.
+    Ключ записи - хэш нормализованного вопроса вместе с моделью и параметрами запроса.
+    Записи живут ttl секунд; при переполнении удаляются давно не использованные (LRU).
+    """
+
+    def __init__(self, db_path, ttl=RESPONSE_CACHE_TTL, max_entries=RESPONSE_CACHE_MAX_ENTRIES):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        with transaction(get_connection(db_path)) as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    key TEXT PRIMARY KEY,
+                    params_key TEXT NOT NULL,
+                    words TEXT NOT NULL,
+                    word_count INTEGER NOT NULL,
+                    response TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS response_cache_params ON response_cache (params_key, word_count)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS response_cache_last_used ON response_cache (last_used)")
+
+    @staticmethod
+    def make_params_key(params):
+        return hashlib.sha256(json.dumps(params, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def make_key(normalized, params_key):
+        return hashlib.sha256(f"{params_key}:{normalized}".encode("utf-8")).hexdigest()
+
+    def get(self, question, params, near_duplicates=False):
+        """
+        Возвращает сохраненный ответ на вопрос с теми же параметрами или None.
+        При near_duplicates ищется и ответ на вопрос, отличающийся порядком или парой слов
+        (но не отрицанием).
+        """
+        normalized = normalize_question(question)
+        params_key = self.make_params_key(params)
+        conn = get_connection(self.db_path)
+        min_created = time.time() - self.ttl
+
+        row = conn.execute(
+            "SELECT key, response FROM response_cache WHERE key = ? AND created_at >= ?",
+            (self.make_key(normalized, params_key), min_created)
+        ).fetchone()
+
+        words = set(normalized.split())
+        if row is None and near_duplicates and len(words) >= NEAR_DUPLICATE_MIN_WORDS:
+            row = self._find_near_duplicate(conn, words, params_key, min_created)
+
+        if row is None:
+            return None
+        with transaction(conn):
+            conn.execute("UPDATE response_cache SET last_used = ? WHERE key = ?", (time.time(), row["key"]))
+        return row["response"]
+
+    def _find_near_duplicate(self, conn, words, params_key, min_created):
+        # Сходство не меньше порога возможно, только если размеры наборов отличаются не сильнее порога
+        rows = conn.execute(
+            """SELECT key, words, response FROM response_cache
+               WHERE params_key = ? AND word_count BETWEEN ? AND ? AND created_at >= ?""",
+            (params_key, int(len(words) * NEAR_DUPLICATE_THRESHOLD),
+             int(len(words) / NEAR_DUPLICATE_THRESHOLD) + 1, min_created)
+        ).fetchall()
+        best, best_score = None, NEAR_DUPLICATE_THRESHOLD
+        for row in rows:
+            other = set(row["words"].split())
+            if (words ^ other) & NEGATION_WORDS:
+                continue
+            score = len(words & other) / len(words | other)
+            if score >= best_score:
+                best, best_score = row, score
+        return best
+
+    def put(self, question, params, response):
+        normalized = normalize_question(question)
+        params_key = self.make_params_key(params)
+        words = sorted(set(normalized.split()))
+        now = time.time()
+        with transaction(get_connection(self.db_path)) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self.make_key(normalized, params_key), params_key, " ".join(words), len(words), response, now, now)
+            )
+            conn.execute("DELETE FROM response_cache WHERE created_at < ?", (now - self.ttl,))
+            count = conn.execute("SELECT COUNT(*) FROM response_cache").fetchone()[0]
+            if count > self.max_entries:
+                conn.execute(
+                    "DELETE FROM response_cache WHERE key IN "
+                    "(SELECT key FROM response_cache ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,)
+                )
@@ -0,0 +1,41 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# Соединения создаются отдельно для каждого потока (Streamlit обслуживает сессии в потоках)
+_local = threading.local()
+
+
+def get_connection(path):
+    """Возвращает соединение с базой SQLite для текущего потока (режим WAL)"""
+    connections = getattr(_local, "connections", None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get(path)
+    if conn is None:
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        # WAL позволяет читателям работать параллельно с единственным писателем
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=30000")
+        connections[path] = conn
+    return conn
+
+
+def table_exists(conn, name):
+    row = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone()
+    return row is not None
+
+
+@contextmanager
+def transaction(conn):
+    """Транзакция с немедленной блокировкой на запись"""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    else:
+        conn.execute("COMMIT")
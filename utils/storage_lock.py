@@ -0,0 +1,125 @@
+import os
+import queue
+import tempfile
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: блокировка только между потоками процесса
+    fcntl = None
+
+
+class _FileLock:
+    """
+    Блокировка записи в файл: RLock между потоками процесса и flock на файле-спутнике
+    path.lock между процессами. Повторный вход тем же потоком не блокируется.
+    """
+
+    def __init__(self, path):
+        self.lock_path = f"{path}.lock"
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._handle = None
+
+    def acquire(self):
+        self._lock.acquire()
+        if self._depth == 0 and fcntl is not None:
+            try:
+                self._handle = open(self.lock_path, "a")
+                fcntl.flock(self._handle, fcntl.LOCK_EX)
+            except Exception:
+                if self._handle is not None:
+                    self._handle.close()
+                    self._handle = None
+                self._lock.release()
+                raise
+        self._depth += 1
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0 and self._handle is not None:
+            fcntl.flock(self._handle, fcntl.LOCK_UN)
+            self._handle.close()
+            self._handle = None
+        self._lock.release()
+
+
+_file_locks = {}
+_file_locks_lock = threading.Lock()
+
+
+@contextmanager
+def file_lock(path):
+    """
+    Эксклюзивная блокировка на запись в файл path.
+    Читатели ее не берут: файлы меняются либо дозаписью, либо атомарной заменой.
+    """
+    path = os.path.abspath(path)
+    with _file_locks_lock:
+        lock = _file_locks.get(path)
+        if lock is None:
+            lock = _file_locks[path] = _FileLock(path)
+    lock.acquire()
+    try:
+        yield
+    finally:
+        lock.release()
+
+
+def write_atomic(path, data):
+    """
+    Записывает файл целиком через уникальный временный файл и атомарное переименование:
+    читатели видят либо старую, либо новую версию, но не частично записанную.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class WriteQueue:
+    """
+    Очередь фоновых записей с единственным потоком-писателем.
+    Записи выполняются строго по очереди; страница не ждет их завершения.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs):
+        future = Future()
+        self._queue.put((future, func, args, kwargs))
+        self._ensure_worker()
+        return future
+
+    def _ensure_worker(self):
+        with self._thread_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="storage-writer", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            future, func, args, kwargs = self._queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception as e:
+                print(f"Ошибка фоновой записи: {str(e)}")
+                future.set_exception(e)
+
+
+write_queue = WriteQueue()
@@ -0,0 +1,43 @@
+from datetime import datetime
+from utils.sqlite_db import get_connection, transaction
+
+
+class SummaryCache:
+    """
+    Постоянный кэш сводок истории чатов в SQLite.
+    Запись привязана к чату и началу диапазона и хранит, до какой позиции
+    и до какого сообщения (id) сводка актуальна.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        with transaction(get_connection(db_path)) as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS context_summaries (
+                    chat_id TEXT NOT NULL,
+                    start_idx INTEGER NOT NULL,
+                    end_idx INTEGER NOT NULL,
+                    last_message_id INTEGER NOT NULL,
+                    summary TEXT NOT NULL,
+                    updated_at TEXT NOT NULL,
+                    PRIMARY KEY (chat_id, start_idx)
+                )
+            """)
+
+    def get(self, chat_id, start_idx):
+        row = get_connection(self.db_path).execute(
+            "SELECT end_idx, last_message_id, summary FROM context_summaries WHERE chat_id = ? AND start_idx = ?",
+            (chat_id, start_idx)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def put(self, chat_id, start_idx, end_idx, last_message_id, summary):
+        with transaction(get_connection(self.db_path)) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO context_summaries VALUES (?, ?, ?, ?, ?, ?)",
+                (chat_id, start_idx, end_idx, last_message_id, summary, datetime.now().isoformat())
+            )
+
+    def invalidate(self, chat_id):
+        with transaction(get_connection(self.db_path)) as conn:
+            conn.execute("DELETE FROM context_summaries WHERE chat_id = ?", (chat_id,))
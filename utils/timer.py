@@ -0,0 +1,53 @@
+import time
+import streamlit as st
+import streamlit.components.v1 as components
+
+TIMER_HEIGHT = 60
+
+
+def display_timer(placeholder=None, start_time=None):
+    """
+    Показывает секундомер, который считает время в браузере.
+    Страница отправляет компонент один раз, поток скрипта при этом не занят.
+    Чтобы остановить секундомер, достаточно заменить или очистить placeholder (stop_timer).
+    """
+    placeholder = placeholder or st.empty()
+    # Передается прошедшее время, а не момент старта: часы сервера и браузера могут расходиться
+    elapsed_ms = int(max(0.0, time.time() - (start_time or time.time())) * 1000)
+    with placeholder:
+        components.html(f"""
+            <div id="timer" style='
+                font-family: sans-serif;
+                font-size: 1.2em;
+                font-weight: bold;
+                color: #1E88E5;
+                padding: 10px;
+                border-radius: 8px;
+                background-color: #E3F2FD;
+                text-align: center;
+                animation: pulse 1s infinite;
+            '>⏱️ 0с</div>
+            <style>
+                @keyframes pulse {{
+                    0% {{ opacity: 1.0; }}
+                    50% {{ opacity: 0.6; }}
+                    100% {{ opacity: 1.0; }}
+                }}
+            </style>
+            <script>
+                const start = Date.now() - {elapsed_ms};
+                const timer = document.getElementById("timer");
+                const tick = () => {{
+                    const seconds = Math.max(0, Math.floor((Date.now() - start) / 1000));
+                    timer.textContent = "⏱️ " + seconds + "с";
+                }};
+                tick();
+                setInterval(tick, 1000);
+            </script>
+        """, height=TIMER_HEIGHT)
+    return placeholder
+
+
+def stop_timer(placeholder):
+    """Убирает секундомер со страницы"""
+    placeholder.empty()
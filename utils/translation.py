@@ -1,29 +1,86 @@
 from googletrans import Translator
 import streamlit as st
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from utils.translation_cache import TranslationCache
+from utils.language_detect import detect_language
+from utils.utils import APP_DB_PATH
 
-# Создаем глобальный экземпляр переводчика
-translator = Translator()
+# Количество фоновых потоков для переводов
+TRANSLATION_WORKERS = 4
 
-def translate_text(text):
-    """Переводит текст между русским и английским языками"""
+translation_cache = TranslationCache(APP_DB_PATH)
+
+_executor = ThreadPoolExecutor(max_workers=TRANSLATION_WORKERS, thread_name_prefix="translation")
+# Переводы, которые уже выполняются в фоне (ключ кэша -> Future)
+_pending = {}
+_pending_lock = threading.Lock()
+# У каждого потока свой экземпляр переводчика
+_local = threading.local()
+
+def _get_translator():
+    if not hasattr(_local, "translator"):
+        _local.translator = Translator()
+    return _local.translator
+
+def get_cached_translation(text, target_lang):
+    """Перевод из постоянного кэша или None"""
+    return translation_cache.get(text, target_lang)
+
+def translate_to(text, target_lang):
+    """Переводит текст на target_lang (синхронно), используя кэш"""
     if not text or not isinstance(text, str):
         return text
+    # Удаленный переводчик нужен, только если язык текста отличается от целевого
+    if detect_language(text) == target_lang:
+        return text
+
+    cached = get_cached_translation(text, target_lang)
+    if cached is not None:
+        return cached
 
     try:
-        # Определяем язык текста
-        detected = translator.detect(text)
-        
-        # Если текст на русском - переводим на английский, иначе на русский
-        target_lang = 'en' if detected.lang == 'ru' else 'ru'
-        
-        translation = translator.translate(text, dest=target_lang)
-        if translation and hasattr(translation, 'text'):
-            return translation.text
-        return text
+        translation = _get_translator().translate(text, dest=target_lang)
+        if not translation or not getattr(translation, 'text', None):
+            return text
+        translation_cache.put(text, target_lang, translation.text)
+        return translation.text
     except Exception as e:
         print(f"Ошибка перевода: {str(e)}")
         return text
 
+def submit_translation(text, target_lang):
+    """Ставит перевод в фоновую очередь и возвращает Future с результатом"""
+    key = TranslationCache.make_key(text, target_lang)
+    with _pending_lock:
+        future = _pending.get(key)
+        if future is None:
+            future = _executor.submit(translate_to, text, target_lang)
+            _pending[key] = future
+            future.add_done_callback(lambda _: _pending.pop(key, None))
+        return future
+
+def get_auto_translation(text, target_lang='ru'):
+    """
+    Возвращает готовый перевод текста на target_lang, не блокируя страницу.
+    Если текст уже на нужном языке - None; если перевода еще нет - запускает его в фоне и возвращает None.
+    """
+    if not text or not isinstance(text, str) or detect_language(text) == target_lang:
+        return None
+    cached = get_cached_translation(text, target_lang)
+    if cached is None:
+        submit_translation(text, target_lang)
+    return cached
+
+def translate_text(text):
+    """Переводит текст между русским и английским языками"""
+    if not text or not isinstance(text, str):
+        return text
+
+    # Если текст на русском - переводим на английский, иначе на русский
+    target_lang = 'en' if detect_language(text) == 'ru' else 'ru'
+    return translate_to(text, target_lang)
+
 def display_message_with_translation(message, message_hash, avatar, role):
     """Отображает сообщение с кнопкой перевода"""
     translation_key = f"translation_{message_hash}"
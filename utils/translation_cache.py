@@ -0,0 +1,39 @@
+import hashlib
+from datetime import datetime
+from utils.sqlite_db import get_connection, transaction
+
+
+class TranslationCache:
+    """
+    Постоянный кэш переводов в SQLite.
+    Ключ записи - хэш текста вместе с языком перевода.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        with transaction(get_connection(db_path)) as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS translations (
+                    key TEXT PRIMARY KEY,
+                    target_lang TEXT NOT NULL,
+                    translated_text TEXT NOT NULL,
+                    created_at TEXT NOT NULL
+                )
+            """)
+
+    @staticmethod
+    def make_key(text, target_lang):
+        return hashlib.sha256(f"{target_lang}:{text}".encode("utf-8")).hexdigest()
+
+    def get(self, text, target_lang):
+        row = get_connection(self.db_path).execute(
+            "SELECT translated_text FROM translations WHERE key = ?", (self.make_key(text, target_lang),)
+        ).fetchone()
+        return row["translated_text"] if row else None
+
+    def put(self, text, target_lang, translated_text):
+        with transaction(get_connection(self.db_path)) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?)",
+                (self.make_key(text, target_lang), target_lang, translated_text, datetime.now().isoformat())
+            )
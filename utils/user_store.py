@@ -0,0 +1,118 @@
+import json
+import os
+from utils.sqlite_db import get_connection, transaction, table_exists
+from utils.storage_lock import write_atomic
+
+
+class UserStore:
+    """
+    Хранилище пользователей в SQLite.
+    Документ пользователя хранится целиком в JSON, а поля для поиска
+    (username, email, active_token) вынесены в индексированные колонки.
+    """
+
+    def __init__(self, db_path, legacy_path=None):
+        self.db_path = db_path
+        self._init_schema(legacy_path)
+
+    @property
+    def conn(self):
+        return get_connection(self.db_path)
+
+    def _init_schema(self, legacy_path):
+        conn = self.conn
+        with transaction(conn):
+            if table_exists(conn, "users"):
+                return
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS users (
+                    username TEXT PRIMARY KEY,
+                    email TEXT,
+                    active_token TEXT,
+                    data TEXT NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS users_email ON users (email)")
+            conn.execute("CREATE INDEX IF NOT EXISTS users_active_token ON users (active_token)")
+            if legacy_path and os.path.exists(legacy_path):
+                self._import_legacy(conn, legacy_path)
+
+    def _import_legacy(self, conn, legacy_path):
+        """Переносит пользователей из user_database.json (TinyDB)"""
+        try:
+            with open(legacy_path, "r", encoding="utf-8") as f:
+                content = f.read()
+            data = json.loads(content) if content.strip() else {}
+        except Exception as e:
+            print(f"Ошибка чтения базы пользователей {legacy_path}: {str(e)}")
+            return
+        table = data.get("_default", {})
+        for doc_id in sorted(table, key=int):
+            user = table[doc_id]
+            if user.get("username"):
+                conn.execute(
+                    "INSERT OR IGNORE INTO users (username, email, active_token, data) VALUES (?, ?, ?, ?)",
+                    self._row(user)
+                )
+        print(f"Перенесено пользователей из {legacy_path}: {len(table)}")
+
+    @staticmethod
+    def _row(user):
+        return (
+            user["username"],
+            user.get("email"),
+            user.get("active_token"),
+            json.dumps(user, ensure_ascii=False)
+        )
+
+    @staticmethod
+    def _load(row):
+        return json.loads(row["data"]) if row else None
+
+    def get(self, username):
+        row = self.conn.execute("SELECT data FROM users WHERE username = ?", (username,)).fetchone()
+        return self._load(row)
+
+    def get_by_email(self, email):
+        row = self.conn.execute("SELECT data FROM users WHERE email = ?", (email,)).fetchone()
+        return self._load(row)
+
+    def get_by_token(self, token):
+        row = self.conn.execute("SELECT data FROM users WHERE active_token = ?", (token,)).fetchone()
+        return self._load(row)
+
+    def all(self):
+        return [self._load(row) for row in self.conn.execute("SELECT data FROM users ORDER BY rowid")]
+
+    def export_json(self, path):
+        """Выгружает всех пользователей в читаемый JSON (для администратора, не для рабочих запросов)"""
+        users = self.all()
+        write_atomic(path, json.dumps(users, ensure_ascii=False, indent=4).encode("utf-8"))
+        return len(users)
+
+    def insert(self, user):
+        """Добавляет пользователя. Возвращает False, если имя уже занято"""
+        with transaction(self.conn) as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO users (username, email, active_token, data) VALUES (?, ?, ?, ?)",
+                self._row(user)
+            )
+            return cursor.rowcount == 1
+
+    def update(self, username, fields, conn=None):
+        """
+        Обновляет поля пользователя (в том числе username). Возвращает False, если пользователь не найден.
+        Если передано соединение conn, обновление выполняется внутри уже открытой транзакции.
+        """
+        if conn is None:
+            with transaction(self.conn) as conn:
+                return self.update(username, fields, conn)
+        row = conn.execute("SELECT data FROM users WHERE username = ?", (username,)).fetchone()
+        if not row:
+            return False
+        user = dict(self._load(row), **fields)
+        conn.execute(
+            "UPDATE users SET username = ?, email = ?, active_token = ?, data = ? WHERE username = ?",
+            self._row(user) + (username,)
+        )
+        return True
@@ -1,12 +1,16 @@
-import json
 import os
 import uuid
 import codecs
-from tinydb import TinyDB, Query
 from datetime import datetime
 from streamlit.runtime.scriptrunner import add_script_run_ctx
 from streamlit import switch_page
 import streamlit as st
+from utils.user_store import UserStore
+from utils.key_store import KeyStore
+from utils.quota import QuotaManager
+from utils.response_cache import ResponseCache
+from utils.summary_cache import SummaryCache
+from utils.sqlite_db import get_connection, transaction
 
 # Определяем базовый путь для файлов данных
 DATA_DIR = "/data" if os.path.exists("/data") else "."
@@ -29,13 +33,30 @@ def ensure_directories():
 
 ensure_directories()
 
-# Инициализация базы данных
-user_db = TinyDB(get_data_file_path('user_database.json'))
-User = Query()
+# Общая база SQLite приложения
+APP_DB_PATH = get_data_file_path('app_data.db')
+
+# Инициализация базы данных (при первом запуске пользователи переносятся из user_database.json)
+user_db = UserStore(APP_DB_PATH, legacy_path=get_data_file_path('user_database.json'))
+
+# Ключи доступа (при первом запуске переносятся из access_keys.json)
+access_keys = KeyStore(APP_DB_PATH, legacy_paths=[
+    os.path.join(os.path.dirname(__file__), '..', 'chat', 'access_keys.json'),
+    get_data_file_path('access_keys.json')
+])
+
+# Кэш ответов простого чата
+response_cache = ResponseCache(APP_DB_PATH)
+
+# Кэш сводок истории чатов
+summary_cache = SummaryCache(APP_DB_PATH)
+
+# Счетчик генераций: резерв перед запросом, списание в памяти, запись в базу пачками
+generation_quota = QuotaManager(user_db, access_keys)
 
 def check_token_status(username):
     """Проверяет статус токена пользователя"""
-    user = user_db.get(User.username == username)
+    user = user_db.get(username)
     
     if not user:
         return False, "Пользователь не найден"
@@ -43,127 +64,76 @@ def check_token_status(username):
     if not user.get('active_token'):
         return False, "Токен не активирован"
         
-    remaining_generations = user.get('remaining_generations', 0)
+    remaining_generations = generation_quota.remaining(username)
     if remaining_generations <= 0:
         # Деактивируем токен если генерации закончились
-        user_db.update({
+        user_db.update(username, {
             'active_token': None,
             'remaining_generations': 0,
             'token_generations': 0
-        }, User.username == username)
+        })
+        generation_quota.reload(username)
         return False, "Токен деактивирован: закончились генерации"
         
     return True, f"Токен активен. Осталось генераций: {remaining_generations}"
 
 def save_token(token, generations=500):
-    chat_dir = os.path.join(os.path.dirname(__file__), '..', 'chat')
-    os.makedirs(chat_dir, exist_ok=True)
-    keys_file = os.path.join(chat_dir, 'access_keys.json')
-    
     try:
-        # Читаем существующие данные или создаем новые
-        if os.path.exists(keys_file):
-            with open(keys_file, 'r', encoding='utf-8') as f:
-                try:
-                    data = json.load(f)
-                except:
-                    data = {"keys": [], "generations": {}}
-        else:
-            data = {"keys": [], "generations": {}}
-        
-        # Добавляем токен
-        token = token.strip('"')
-        if token not in data["keys"]:
-            data["keys"].append(token)
-        data["generations"][token] = generations
-        
-        # Сохраняем данные
-        with open(keys_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
+        access_keys.add(token, generations)
         return True
     except Exception as e:
         print(f"Error saving token: {str(e)}")
         return False
 
-def load_access_keys():
-    chat_dir = os.path.join(os.path.dirname(__file__), '..', 'chat')
-    os.makedirs(chat_dir, exist_ok=True)
-    keys_file = os.path.join(chat_dir, 'access_keys.json')
-    
-    try:
-        if os.path.exists(keys_file):
-            with open(keys_file, 'r', encoding='utf-8') as f:
-                try:
-                    data = json.load(f)
-                    if isinstance(data, dict) and "keys" in data:
-                        return data["keys"]
-                except:
-                    return []
-        return []
-    except Exception as e:
-        print(f"Error loading keys: {str(e)}")
-        return []
-
 def remove_used_key(used_key):
-    json_file = os.path.join(os.path.dirname(__file__), '..', 'chat', 'access_keys.json')
-    
     try:
-        if not os.path.exists(json_file):
-            return False
-        
-        with open(json_file, 'r', encoding='utf-8') as f:
-            try:
-                data = json.load(f)
-            except:
-                data = {"keys": [], "generations": {}}
-        
-        if used_key in data.get('keys', []):
-            data['keys'].remove(used_key)
-        elif f'"{used_key}"' in data.get('keys', []):
-            data['keys'].remove(f'"{used_key}"')
-        
-        if used_key in data.get('generations', {}):
-            del data['generations'][used_key]
-        
-        with open(json_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
+        access_keys.remove(used_key)
         return True
     except Exception as e:
         print(f"Ошибка при удалении ключа: {str(e)}")
         return False
 
+def activate_token(token, username):
+    """
+    Погашает ключ и привязывает его к пользователю одной транзакцией.
+    Возвращает количество генераций или None, если ключ недействителен.
+    """
+    # Несохраненные списания относятся к старому ключу - записываем их до активации
+    generation_quota.flush(username)
+    with transaction(get_connection(APP_DB_PATH)) as conn:
+        generations = access_keys.consume(token, conn=conn)
+        if generations is None:
+            return None
+        user_db.update(username, {
+            'active_token': token,
+            'remaining_generations': generations
+        }, conn=conn)
+    generation_quota.reload(username)
+    return generations
+
 def update_remaining_generations(username, remaining):
-    user = user_db.get(User.username == username)
-    
-    if not user:
+    """
+    Списывает генерации (remaining < 0) или устанавливает их количество.
+    Списание идет через счетчик generation_quota и записывается в базу пачками.
+    """
+    if not user_db.get(username):
         return False
     
-    current_generations = user.get('remaining_generations', 0)
-    
     if remaining < 0:
-        new_remaining = current_generations + remaining
-    else:
-        new_remaining = remaining
-    
-    if new_remaining <= 0:
-        if user.get('active_token'):
-            used_key = user['active_token']
-            remove_used_key(used_key)
-            
-            user_db.update({
-                'active_token': None,
-                'remaining_generations': 0,
-                'token_generations': 0
-            }, User.username == username)
-            
-            if 'access_granted' in st.session_state:
-                st.session_state.access_granted = False
+        generation_quota.spend(username, -remaining)
     else:
-        user_db.update({
-            'remaining_generations': new_remaining,
-            'token_generations': new_remaining
-        }, User.username == username)
+        generation_quota.flush(username)
+        fields = {
+            'remaining_generations': remaining,
+            'token_generations': remaining
+        }
+        if remaining == 0:
+            fields['active_token'] = None
+        user_db.update(username, fields)
+        generation_quota.reload(username)
     
+    if generation_quota.remaining(username) <= 0 and 'access_granted' in st.session_state:
+        st.session_state.access_granted = False
     return True
 
 def verify_user_access():
@@ -172,7 +142,7 @@ def verify_user_access():
         switch_page("registr")
         return False
     
-    user = user_db.get(User.username == st.session_state.username)
+    user = user_db.get(st.session_state.username)
     if not user or not user.get('active_token'):
         st.warning("Необходим активный токен")
         switch_page("key_input")
@@ -180,17 +150,6 @@ def verify_user_access():
     
     return True
 
-def format_database():
-    try:
-        with open(get_data_file_path('user_database.json'), 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        with open(get_data_file_path('user_database.json'), 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
-        return True
-    except Exception as e:
-        print(f"Ошибка форматирования базы данных: {str(e)}")
-        return False
-
 def generate_unique_token():
     return str(uuid.uuid4())
 
@@ -199,3 +158,13 @@ def generate_and_save_token(generations=500):
     if save_token(new_token, generations):
         return new_token
     return None
+
+def generate_and_save_tokens(count, generations=500):
+    """Генерирует пачку ключей и сохраняет их одной транзакцией"""
+    new_tokens = [generate_unique_token() for _ in range(count)]
+    try:
+        access_keys.add_many(new_tokens, generations)
+        return new_tokens
+    except Exception as e:
+        print(f"Error saving tokens: {str(e)}")
+        return []